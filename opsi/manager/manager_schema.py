@@ -1,9 +1,24 @@
 import logging
 from dataclasses import Field, dataclass, fields, is_dataclass
-from typing import Any, Callable, Dict, List, NamedTuple, Type, get_type_hints
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    get_type_hints,
+)
 
 LOGGER = logging.getLogger(__name__)
 
+# Pixel formats of Mat inputs, see Function.input_formats
+BGR = "bgr"
+GREY = "grey"  # Single channel
+
 
 def isinstance_partial(type: Type) -> Callable[[Any], bool]:
     def partial(obj) -> bool:
@@ -23,10 +38,16 @@ def does_match(cls, name: str, asserter: Callable[[Any], bool]) -> bool:
 
 class Function:
     has_sideeffect: bool = False
-    require_restart: bool = False
+    # True to restart when settings change, or the names of the settings which
+    # need it. Functions see other changes in self.settings while running
+    require_restart: Union[bool, Tuple[str, ...]] = False
     always_restart: bool = False
     disabled = False
 
+    # {input name: pixel format}, for Mat inputs that need one other than BGR.
+    # Functions producing them are told, see negotiate_formats
+    input_formats: Dict[str, str] = {}
+
     SettingTypes: List[Field]
     InputTypes: Dict[str, Type]
     OutputTypes: Dict[str, Type]
@@ -109,6 +130,12 @@ class Function:
     def on_start(self):
         pass
 
+    def negotiate_formats(self, formats: Dict[str, Set[str]]):
+        # {output name: pixel formats the functions linked to it need}, given
+        # whenever the links change. An output can then skip converting to a
+        # format none of them need
+        pass
+
     @classmethod
     def validate_settings(cls, settings):
         return settings
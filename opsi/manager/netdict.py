@@ -1,8 +1,19 @@
-from typing import Callable, List, Union
+import logging
+import threading
+from collections import deque
+from time import perf_counter, sleep
+from typing import Callable, Dict, List, Union
 
 try:
     from _pynetworktables._impl.api import NtCoreApi
-    from _pynetworktables._impl.constants import NT_UNASSIGNED
+    from _pynetworktables._impl.constants import (
+        NT_NOTIFY_DELETE,
+        NT_NOTIFY_IMMEDIATE,
+        NT_NOTIFY_LOCAL,
+        NT_NOTIFY_NEW,
+        NT_NOTIFY_UPDATE,
+        NT_UNASSIGNED,
+    )
     from _pynetworktables._impl.value import Value
     from networktables import NetworkTableEntry, NetworkTables, NetworkTablesInstance
 
@@ -11,6 +22,8 @@ except ImportError:
     NT_AVAIL = False
     NetworkTables = None
 
+LOGGER = logging.getLogger(__name__)
+
 # These are the types that are allowed to be stored in NT
 # Not the actual types themselves, these are the Python equivalents
 NT_TYPES = Union[
@@ -29,6 +42,44 @@ NT_TYPES = Union[
 _missing = object()
 
 
+def _value_kind(value):  # What Value.getFactory picks the factory by
+    if isinstance(value, (list, tuple)):
+        return (list, type(value[0]) if value else None)
+    return type(value)
+
+
+_EMPTY_ARRAY = (list, None)
+
+
+def value_factory(value) -> Callable[..., "Value"]:
+    # The Value factory for a Python value, raising TypeError if NT cannot hold it.
+    # Only the first item of a list is checked
+    try:
+        return Value.getFactory(value)
+    except ValueError as e:  # It should raise TypeError
+        raise TypeError(*e.args)
+
+
+def _has_batch_api(storage) -> bool:  # See NetworkDict._write_batch
+    return all(
+        hasattr(storage, name)
+        for name in ("__enter__", "m_entries", "_getOrNew", "_setEntryValueImpl")
+    )
+
+
+class _Published:
+    # An entry handle, and what was last written to it through publish
+    __slots__ = ("path", "entry", "kind", "factory", "value", "nt_value")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entry = None
+        self.kind = None
+        self.factory = None
+        self.value = _missing
+        self.nt_value = None
+
+
 class NetworkDict:
     def __init__(self, table: str, networktable: "NetworkTablesInstance" = None):
         self.networktable = networktable or NetworkTables
@@ -38,6 +89,7 @@ class NetworkDict:
             + self._cleanup_path(table)
             + self.networktable.PATH_SEPARATOR
         )
+        self._published: Dict[str, _Published] = {}
 
     # Helper methods
 
@@ -147,11 +199,131 @@ class NetworkDict:
         if entry is None:
             raise KeyError(name)
 
+        self._published.pop(name, None)
         self.api.deleteEntry(self._get_path(name))
 
     def exists(self, name: str) -> bool:
         return self._get_entry(name) is not None
 
+    # Listening
+
+    def add_listener(self, name: str, callback: Callable[[NT_TYPES], None]) -> int:
+        """
+        Calls callback(value) on the NT notifier thread whenever the value of the
+        entry changes, and right away if it already has a value. The value is None
+        if the entry was deleted. Returns an id for remove_listener
+        """
+
+        if not isinstance(name, str):
+            raise TypeError("Key must be type str")
+
+        def listener(notification):
+            if notification.flags & NT_NOTIFY_DELETE:
+                callback(None)
+            else:
+                callback(notification.value.value)
+
+        local_id = self.api.storage.getEntryId(self._get_path(name))
+        flags = (
+            NT_NOTIFY_IMMEDIATE
+            | NT_NOTIFY_LOCAL
+            | NT_NOTIFY_NEW
+            | NT_NOTIFY_UPDATE
+            | NT_NOTIFY_DELETE
+        )
+
+        return self.api.addEntryListenerById(local_id, listener, flags)
+
+    def remove_listener(self, listener_id: int) -> None:
+        self.api.removeEntryListener(listener_id)
+
+    # Publishing
+
+    def publish(self, values: Dict[str, NT_TYPES]) -> None:
+        """
+        Like set for every item of values, but written in one batch under a single
+        storage lock. Entry handles and value factories are cached per key, and
+        values which have not changed since they were last published are skipped.
+        Raises TypeError for any values NT cannot hold, after writing the rest
+        """
+
+        pending = []
+        failed = []
+        for name, value in values.items():
+            try:
+                published = self._published.get(name)
+                if published is None:
+                    if not isinstance(name, str):
+                        raise TypeError("Key must be type str")
+                    path = self._get_path(name)
+                    published = self._published[name] = _Published(path)
+
+                kind = _value_kind(value)
+                # An empty list can be written with the array factory used before it
+                reuse = kind == _EMPTY_ARRAY and isinstance(published.kind, tuple)
+
+                if kind != published.kind and not reuse:
+                    published.factory = value_factory(value)
+                    published.kind = kind
+
+                # If anything else wrote to the entry, its value is no longer ours
+                elif (
+                    published.entry is not None
+                    and published.entry.value is published.nt_value
+                    and published.value == value
+                ):
+                    continue
+
+                # Raises ValueError for lists with items of different types
+                pending.append((published, value, published.factory(value)))
+            except (TypeError, ValueError) as e:
+                failed.append(f"{name!r} ({e})")
+
+        if pending:
+            self._write_batch(pending)
+
+        if failed:
+            raise TypeError(f"Cannot write to NT: {', '.join(failed)}")
+
+    # Set when the pynetworktables internals _write_batch uses failed, so every
+    # table publishes through the public API from then on
+    _batch_failed = False
+
+    def _write_batch(self, pending) -> None:
+        """
+        Writes [(published, value, nt_value)] under a single storage lock. The
+        lock and _setEntryValueImpl are not public API, so if this version of
+        pynetworktables lacks them, or they fail, values are written one at a
+        time through public entries instead
+        """
+
+        storage = self.api.storage
+        if not NetworkDict._batch_failed and _has_batch_api(storage):
+            try:
+                with storage as outgoing:
+                    for published, value, nt_value in pending:
+                        # Handles are invalidated by the entry being deleted
+                        path = published.path
+                        entry = storage.m_entries.get(path)
+                        if entry is None or entry is not published.entry:
+                            entry = published.entry = storage._getOrNew(path)
+
+                        storage._setEntryValueImpl(entry, nt_value, outgoing, True)
+                        published.value = value
+                        published.nt_value = entry.value
+                return
+            except (AttributeError, TypeError):
+                LOGGER.warning(
+                    "Batched NT writes failed, using the public API", exc_info=True
+                )
+                NetworkDict._batch_failed = True
+
+        for published, value, nt_value in pending:
+            # Like set, this may change the type of the entry
+            self.networktable.getEntry(published.path).forceSetValue(value)
+            published.entry = None  # Not ours to compare with, so always written
+            published.value = value
+
     # Implement dict-like interface
 
     def __getitem__(self, key) -> NT_TYPES:
@@ -167,6 +339,120 @@ class NetworkDict:
         return self.exists(key)
 
 
+class NTPublisher:
+    """
+    Publishes to NT on its own thread, so the pipeline never waits for NT.
+    Values submitted while a frame runs are handed over together by end_frame.
+    Frames which arrive faster than max_rate are coalesced, with the latest value
+    of each key winning
+    """
+
+    SAMPLES = 100
+
+    def __init__(self, max_rate: float = 100):
+        self.max_rate = max_rate  # Flushes per second; 0 for no limit
+        self.coalesced = 0  # Frames replaced by a newer one before being published
+
+        # Per flush, seconds from end_frame to flushed, and seconds spent publishing
+        self._latencies = deque(maxlen=self.SAMPLES)
+        self._publish_times = deque(maxlen=self.SAMPLES)
+
+        self._frame: Dict[NetworkDict, Dict[str, NT_TYPES]] = {}  # pipeline thread only
+        self._pending: Dict[NetworkDict, Dict[str, NT_TYPES]] = {}
+        self._pending_at = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    # Called from the pipeline thread
+
+    def submit(self, table: NetworkDict, values: Dict[str, NT_TYPES]) -> None:
+        frame = self._frame.get(table)
+        if frame is None:
+            self._frame[table] = values
+        else:
+            frame.update(values)
+
+    def end_frame(self) -> None:
+        if not self._frame:
+            return
+
+        with self._condition:
+            if self._pending:
+                self.coalesced += 1
+
+            for table, values in self._frame.items():
+                pending = self._pending.get(table)
+                if pending is None:
+                    self._pending[table] = values
+                else:
+                    pending.update(values)
+
+            self._pending_at = perf_counter()
+            self._condition.notify()
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="NT publisher", daemon=True
+                )
+                self._thread.start()
+
+        self._frame = {}
+
+    def stop(self) -> None:
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._condition.notify()
+
+        if thread is not None:
+            thread.join()
+
+    def samples(self):  # (latencies, publish_times), see __init__
+        with self._condition:
+            return list(self._latencies), list(self._publish_times)
+
+    # Publisher thread
+
+    def _run(self):
+        thread = threading.current_thread()
+        last_flush = 0
+
+        while True:
+            with self._condition:
+                while self._thread is thread and not self._pending:
+                    self._condition.wait()
+                if self._thread is not thread:
+                    return
+
+            # Newer frames arriving in the meantime are coalesced into this one
+            if self.max_rate > 0:
+                delay = last_flush + (1 / self.max_rate) - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+
+            with self._condition:
+                pending, self._pending = self._pending, {}
+                pending_at = self._pending_at
+
+            start = perf_counter()
+            for table, values in pending.items():
+                try:
+                    table.publish(values)
+                except Exception:
+                    LOGGER.exception("Failed to publish to NT table %s", table.path)
+
+            # Values are in local storage either way, flushing only sends them on
+            for networktable in {table.networktable for table in pending}:
+                if networktable.isConnected():
+                    networktable.flush()
+
+            last_flush = perf_counter()
+            with self._condition:
+                self._latencies.append(last_flush - pending_at)
+                self._publish_times.append(last_flush - start)
+
+
+NT_PUBLISHER = NTPublisher()
+
 """
 Example usage:
 
@@ -12,8 +12,8 @@ from opsi.util.concurrency import FifoLock
 from opsi.util.fps import FPS
 
 from .link import Link, NodeLink, StaticLink
-from .manager_schema import Function, Hook
-from .netdict import NT_AVAIL, NetworkTables
+from .manager_schema import BGR, Function, Hook
+from .netdict import NT_AVAIL, NT_PUBLISHER
 
 LOGGER = logging.getLogger(__name__)
 
@@ -165,6 +165,7 @@ class Node:
         self.skip: bool = False
 
         self.settings = None
+        self.output_formats: Dict[str, Set[str]] = {}  # See Pipeline.negotiate_formats
 
     def next_frame(self):
         self.results = None
@@ -178,6 +179,12 @@ class Node:
             return
 
         self.func = self.func_type(self.settings)
+        self.func.negotiate_formats(self.output_formats)
+
+    def set_output_formats(self, formats: Dict[str, Set[str]]):
+        self.output_formats = formats
+        if self.func is not None:
+            self.func.negotiate_formats(formats)
 
     def dispose(self):
         if self.func is None:
@@ -253,6 +260,7 @@ class Pipeline:
 
         if not self.run_order:
             self.run_order = list(chain.from_iterable(toposort(self.adjList)))
+            self.negotiate_formats()
 
         if self.benchmarking:
             self.perf.new_run()
@@ -283,8 +291,8 @@ class Pipeline:
             try:
                 with self.lock:
                     self.run()
-                if NT_AVAIL:
-                    NetworkTables.flush()
+                if NT_AVAIL:  # Hand this frame's NT values to the publisher thread
+                    NT_PUBLISHER.end_frame()
 
             except (TypeError, AttributeError):
                 LOGGER.debug(
@@ -382,6 +390,31 @@ class Pipeline:
 
             return self.perf.calculate()
 
+    def get_nt_publish_stats(self) -> Dict[str, CalculatedItemPerformance]:
+        # Measured on the NT publisher thread, so not part of get_benchmark_stats
+        latencies, publish_times = NT_PUBLISHER.samples()
+        if not latencies:
+            raise ValueError("Nothing has been published to NT")
+
+        return {
+            "latency": CalculatedItemPerformance.calculate(latencies),
+            "publish": CalculatedItemPerformance.calculate(publish_times),
+        }
+
+    def negotiate_formats(self):
+        # Tells each node the pixel formats the nodes linked to its outputs need
+        formats = {node: {} for node in self.nodes.values()}
+
+        for node in self.nodes.values():
+            for name, link in node.inputLinks.items():
+                if not isinstance(link, NodeLink):
+                    continue
+                format = node.func_type.input_formats.get(name, BGR)
+                formats[link.node].setdefault(link.name, set()).add(format)
+
+        for node, output_formats in formats.items():
+            node.set_output_formats(output_formats)
+
     def create_links(self, input_node_id, links: Links):
         self.run_order.clear()
         input_node = self.nodes[input_node_id]
@@ -3,7 +3,7 @@ from dataclasses import dataclass
 import cv2
 import numpy as np
 
-from opsi.manager.manager_schema import Function
+from opsi.manager.manager_schema import GREY, Function
 from opsi.manager.types import RangeType, Slide
 from opsi.util.cv import Mat, MatBW
 from opsi.util.cv.mat import Color
@@ -53,7 +53,44 @@ class HSVRange(Function):
         return self.Outputs(imgBW=imgBW)
 
 
+class MultiHSVRange(Function):
+    @dataclass
+    class Settings:
+        hue1: RangeType(0, 359)
+        sat1: RangeType(0, 255)
+        val1: RangeType(0, 255)
+        hue2: RangeType(0, 359)
+        sat2: RangeType(0, 255)
+        val2: RangeType(0, 255)
+        hue3: RangeType(0, 359)
+        sat3: RangeType(0, 255)
+        val3: RangeType(0, 255)
+
+    @dataclass
+    class Inputs:
+        img: Mat
+
+    @dataclass
+    class Outputs:
+        imgBW1: MatBW
+        imgBW2: MatBW
+        imgBW3: MatBW
+
+    def run(self, inputs):
+        s = self.settings
+        imgBW1, imgBW2, imgBW3 = inputs.img.mat.hsv_threshold_multi(
+            (
+                (s.hue1, s.sat1, s.val1),
+                (s.hue2, s.sat2, s.val2),
+                (s.hue3, s.sat3, s.val3),
+            )
+        )
+        return self.Outputs(imgBW1=imgBW1, imgBW2=imgBW2, imgBW3=imgBW3)
+
+
 class Greyscale(Function):
+    input_formats = {"img": GREY}
+
     @dataclass
     class Inputs:
         img: Mat
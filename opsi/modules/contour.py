@@ -5,15 +5,22 @@ from functools import lru_cache
 import cv2
 import numpy as np
 
-from opsi.manager.manager_schema import Function
+from opsi.manager.manager_schema import Function, Hook
+from opsi.manager.types import Slide
 from opsi.util.cv import Contours, Mat, MatBW, Point
 from opsi.util.cv.shape import Corners
 
 __package__ = "opsi.contours"
 __version__ = "0.123"
 
+HookInstance = Hook()
+
 
 class FindContours(Function):
+    @dataclass
+    class Settings:
+        pyramid_levels: Slide(min=0, max=3, decimal=False) = 0
+
     @dataclass
     class Inputs:
         imgBW: MatBW
@@ -23,7 +30,7 @@ class FindContours(Function):
         contours: Contours
 
     def run(self, inputs):
-        contours = Contours.from_img(inputs.imgBW)
+        contours = Contours.from_img(inputs.imgBW, self.settings.pyramid_levels)
         return self.Outputs(contours=contours)
 
 
@@ -77,22 +84,17 @@ class FindCenter(Function):
         success: bool
 
     def run(self, inputs):
-        if len(inputs.contours.l) == 0:
+        batch = inputs.contours.batch
+        if len(batch) == 0:
             return self.Outputs(center=None, success=False, visual=inputs.img)
-        res = inputs.contours.l[0].res
+        res = batch.res
         center = inputs.contours.centroid_of_all
 
         if self.settings.draw:
             img = np.copy(inputs.img.mat.img)
 
-            for contour in inputs.contours.l:
-                cv2.circle(
-                    img,
-                    (int(contour.pixel_centroid[0]), int(contour.pixel_centroid[1])),
-                    5,
-                    (0, 0, 255),
-                    3,
-                )
+            for x, y in batch.pixel_centroids.astype(int).tolist():
+                cv2.circle(img, (x, y), 5, (0, 0, 255), 3)
 
             cv2.circle(img, (int(center.x), int(center.y)), 10, (255, 0, 0), 5)
             img = Mat(img)
@@ -135,6 +137,16 @@ class FindAngle(Function):
 
         return H_FOCAL_LENGTH, V_FOCAL_LENGTH
 
+    @classmethod
+    def calculate_angle(cls, x, y, h_focal_length, v_focal_length, degrees=False):
+        # x and y can also be arrays, such as the columns of ContourBatch.centroids
+        angle = Point(x=np.arctan2(x, h_focal_length), y=np.arctan2(y, v_focal_length))
+
+        if degrees:
+            angle = Point(x=np.degrees(angle.x), y=np.degrees(angle.y))
+
+        return angle
+
     @dataclass
     class Settings:
         mode: ("Degrees", "Radians") = "Radians"
@@ -150,8 +162,8 @@ class FindAngle(Function):
         angle: Point
 
     def run(self, inputs):
-        width = inputs.img.res.x
-        height = inputs.img.res.y
+        width = inputs.img.full_res.x
+        height = inputs.img.full_res.y
 
         x = inputs.point.x
         y = inputs.point.y
@@ -160,17 +172,15 @@ class FindAngle(Function):
             self.settings.diagonalFOV, width, height
         )
 
-        if self.settings.mode == "Radians":
-            radians = Point(
-                x=math.atan2(x, h_focal_length), y=math.atan2(y, v_focal_length)
-            )
-            return self.Outputs(angle=radians)
-        else:
-            degrees = Point(
-                x=math.degrees(math.atan2(x, h_focal_length)),
-                y=math.degrees(math.atan2(y, v_focal_length)),
-            )
-            return self.Outputs(angle=degrees)
+        angle = self.calculate_angle(
+            x,
+            y,
+            h_focal_length,
+            v_focal_length,
+            degrees=self.settings.mode == "Degrees",
+        )
+
+        return self.Outputs(angle=Point(x=float(angle.x), y=float(angle.y)))
 
 
 class FindCorners(Function):
@@ -184,14 +194,15 @@ class FindCorners(Function):
         success: bool
 
     def run(self, inputs):
-        if len(inputs.contours.l) == 0:
+        batch = inputs.contours.batch
+        if len(batch) == 0:
             return self.Outputs(corners=None, success=False)
 
-        cnt = inputs.contours.l[0]
-
-        ret, corners = cnt.corners
+        found, corners = batch.take([0]).corners
+        if not found[0]:
+            return self.Outputs(corners=None, success=False)
 
-        return self.Outputs(corners=corners, success=ret)
+        return self.Outputs(corners=Corners.from_array(corners[0]), success=True)
 
 
 class FindArea(Function):
@@ -204,7 +215,89 @@ class FindArea(Function):
         area: float
 
     def run(self, inputs):
-        if inputs.contours is None or len(inputs.contours.l) == 0:
+        if inputs.contours is None or len(inputs.contours.raw) == 0:
             return self.Outputs(area=0)
         else:
-            return self.Outputs(area=sum([cnt.area for cnt in inputs.contours.l]))
+            return self.Outputs(area=float(inputs.contours.batch.areas.sum()))
+
+
+# {name: TrackROI}, so UpdateROI can find the tracker it updates. The window
+# itself is kept by the tracker, and goes with it when it is disposed
+ROI_TRACKERS = {}
+
+
+class TrackROI(Function):
+    require_restart = ("name",)
+
+    @dataclass
+    class Settings:
+        name: str = "target"
+        padding_pct: Slide(min=0, max=200) = 50
+
+    @classmethod
+    def validate_settings(cls, settings):
+        settings.name = settings.name.strip()
+        return settings
+
+    @dataclass
+    class Inputs:
+        img: Mat
+
+    @dataclass
+    class Outputs:
+        img: Mat = None
+        tracking: bool = False
+
+    def on_start(self):
+        # Region to search next frame in full frame coordinates, or None to
+        # search the full frame
+        self.window = None
+
+        if self.settings.name in ROI_TRACKERS:
+            raise ValueError(f"ROI {self.settings.name} already in use")
+        ROI_TRACKERS[self.settings.name] = self
+
+    def run(self, inputs):
+        window = self.window
+        if window is None:  # target lost, search the full frame
+            return self.Outputs(img=inputs.img, tracking=False)
+
+        pad = self.settings.padding_pct / 100.0
+        window = window.expand(window.dim.x * pad, window.dim.y * pad)
+
+        img = inputs.img.roi(window)
+        if img is None:  # The window left the frame, so there is nothing in it
+            self.window = None
+            HookInstance.cancel_output("img")
+            return self.Outputs(tracking=False)
+
+        return self.Outputs(img=img, tracking=True)
+
+    def dispose(self):
+        if ROI_TRACKERS.get(self.settings.name) is self:
+            del ROI_TRACKERS[self.settings.name]
+
+
+class UpdateROI(Function):
+    has_sideeffect = True
+
+    @dataclass
+    class Settings:
+        name: str = "target"
+
+    @classmethod
+    def validate_settings(cls, settings):
+        settings.name = settings.name.strip()
+        return settings
+
+    @dataclass
+    class Inputs:
+        contours: Contours
+
+    def run(self, inputs):
+        tracker = ROI_TRACKERS.get(self.settings.name)
+        if tracker is not None:
+            contours = inputs.contours
+            tracker.window = contours.bounding_rect if contours is not None else None
+
+        return self.Outputs()
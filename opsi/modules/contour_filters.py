@@ -1,16 +1,29 @@
 from dataclasses import dataclass
 
+import numpy as np
+from numpy import ndarray
+
 from opsi.manager.manager_schema import Function
 from opsi.manager.types import RangeType, Slide
-from opsi.util.cv import Contour, Contours
+from opsi.util.cv import Contour, ContourBatch, Contours
 
 __package__ = "opsi.contour-filter-ops"
 __version__ = "0.123"
 
+# Filters work on the ContourBatch of their input and pass a subset of it on,
+# so properties computed by one filter in a chain are reused by the next ones,
+# and no Contour objects are created unless a later node asks for them
+
 
 class ContourFilter(Function):
     disabled = True
 
+    # Returns a boolean mask of the contours to keep
+    def check_batch(self, batch: ContourBatch) -> ndarray:
+        # Fallback for filters which only implement check_contour
+        contours = Contours.from_batch(batch).l
+        return np.array([self.check_contour(cnt) for cnt in contours], dtype=bool)
+
     def check_contour(self, contour: Contour) -> bool:
         raise NotImplementedError()
 
@@ -23,15 +36,22 @@ class ContourFilter(Function):
         contours: Contours
 
     def run(self, inputs):
-        contours = inputs.contours.l
+        batch = inputs.contours.batch
 
         # Don't bother filtering if there are no contours in the input
-        if len(contours) == 0:
+        if len(batch) == 0:
             return self.Outputs(contours=Contours.from_contours([]))
 
-        return self.Outputs(
-            contours=Contours.from_contours(list(filter(self.check_contour, contours)))
-        )
+        # Degenerate contours divide by zero, and are filtered out by the nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mask = self.check_batch(batch)
+
+        return self.Outputs(contours=Contours.from_batch(batch.take(mask)))
+
+
+def _min_area_rect_areas(batch: ContourBatch) -> ndarray:
+    dims = batch.min_area_rects[1]
+    return dims[:, 0] * dims[:, 1]
 
 
 class AreaFilter(ContourFilter):
@@ -44,9 +64,11 @@ class AreaFilter(ContourFilter):
         min_area_pct: float = 0.0
         max_area_pct: float = 100.0
 
-    def check_contour(self, contour: Contour) -> bool:
-        area_pct = contour.area * 100.0
-        return self.settings.min_area_pct < area_pct < self.settings.max_area_pct
+    def check_batch(self, batch: ContourBatch) -> ndarray:
+        area_pct = batch.areas * 100.0
+        return (self.settings.min_area_pct < area_pct) & (
+            area_pct < self.settings.max_area_pct
+        )
 
 
 class BoundingRectFilter(ContourFilter):
@@ -56,18 +78,17 @@ class BoundingRectFilter(ContourFilter):
     class Settings:
         bounding_rectangle_pct: RangeType(min=0, max=100)
 
-    def check_contour(self, contour: Contour) -> bool:
-        screen_area = contour.res.area
-        rect_area_pct = contour.to_rect.area / screen_area
+    def check_batch(self, batch: ContourBatch) -> ndarray:
+        screen_area = batch.res.area
+        rects = batch.bounding_rects
+        rect_area_pct = (rects[:, 2] * rects[:, 3]) / screen_area
 
-        contour_area_pct = contour.area
+        contour_area_pct = batch.areas
 
         area_pct = (contour_area_pct / rect_area_pct) * 100.0
 
-        return (
-            self.settings.bounding_rectangle_pct.min
-            < area_pct
-            < self.settings.bounding_rectangle_pct.max
+        return (self.settings.bounding_rectangle_pct.min < area_pct) & (
+            area_pct < self.settings.bounding_rectangle_pct.max
         )
 
 
@@ -78,15 +99,15 @@ class MinRectFilter(ContourFilter):
     class Settings:
         rectangle_pct: RangeType(min=0, max=100)
 
-    def check_contour(self, contour: Contour) -> bool:
-        screen_area = contour.res.area
-        rect_area_pct = contour.to_min_area_rect.area / screen_area
+    def check_batch(self, batch: ContourBatch) -> ndarray:
+        screen_area = batch.res.area
+        rect_area_pct = _min_area_rect_areas(batch) / screen_area
 
-        contour_area_pct = contour.area
+        contour_area_pct = batch.areas
 
         area_pct = (contour_area_pct / rect_area_pct) * 100.0
-        return (
-            self.settings.rectangle_pct.min < area_pct < self.settings.rectangle_pct.max
+        return (self.settings.rectangle_pct.min < area_pct) & (
+            area_pct < self.settings.rectangle_pct.max
         )
 
 
@@ -104,19 +125,19 @@ class SpeckleFilter(Function):
         min_relative_area: Slide(min=0, max=100)
 
     def run(self, inputs):
-        contours = inputs.contours.l
-        if len(contours) == 0:
+        batch = inputs.contours.batch
+        if len(batch) == 0:
             return self.Outputs(contours=Contours.from_contours([]))
 
         # Find the area of the largest contour
-        largest_area = max(contours, key=lambda contour: contour.area).area
+        largest_area = batch.areas.max()
 
         # Any contour below this area is considered a "speckle"
         speckle_threshold = largest_area * self.settings.min_relative_area / 100.0
 
-        filtered = filter(lambda contour: contour.area > speckle_threshold, contours)
+        filtered = batch.take(batch.areas > speckle_threshold)
 
-        return self.Outputs(contours=Contours.from_contours(list(filtered)))
+        return self.Outputs(contours=Contours.from_batch(filtered))
 
 
 class AspectRatioFilter(ContourFilter):
@@ -127,20 +148,15 @@ class AspectRatioFilter(ContourFilter):
         aspect_ratio_min: float = 1.0
         aspect_ratio_max: float = 10.0
 
-    def check_contour(self, contour: Contour) -> bool:
+    def check_batch(self, batch: ContourBatch) -> ndarray:
         # Dimensions of the minimum area rectangle
-        dim = contour.to_min_area_rect.dim
+        dims = batch.min_area_rects[1]
 
         # Make sure aspect ratio is > 1
-        if dim[0] > dim[1]:
-            aspect_ratio = dim[0] / dim[1]
-        else:
-            aspect_ratio = dim[1] / dim[0]
+        aspect_ratio = dims.max(axis=1) / dims.min(axis=1)
 
-        return (
-            self.settings.aspect_ratio_min
-            < aspect_ratio
-            < self.settings.aspect_ratio_max
+        return (self.settings.aspect_ratio_min < aspect_ratio) & (
+            aspect_ratio < self.settings.aspect_ratio_max
         )
 
 
@@ -151,16 +167,16 @@ class OrientationFilter(ContourFilter):
     class Settings:
         orientation: ("Vertical", "Horizontal")
 
-    def check_contour(self, contour: Contour) -> bool:
+    def check_batch(self, batch: ContourBatch) -> ndarray:
         # angle from vertical of the minimum area rectangle
-        angle = contour.to_min_area_rect.vertical_angle
+        angle = batch.vertical_angles
 
         if self.settings.orientation == "Vertical":
-            return -45 <= angle <= 45
+            return (-45 <= angle) & (angle <= 45)
         elif self.settings.orientation == "Horizontal":
-            return angle <= -45 or angle >= 45
+            return (angle <= -45) | (angle >= 45)
         else:
-            return False
+            return np.zeros(len(batch), dtype=bool)
 
 
 class AngleFilter(ContourFilter):
@@ -170,25 +186,52 @@ class AngleFilter(ContourFilter):
     class Settings:
         angle: RangeType(min=-45, max=45)
 
-    def check_contour(self, contour: Contour) -> bool:
+    def check_batch(self, batch: ContourBatch) -> ndarray:
         # angle from vertical of the minimum area rectangle
-        angle = contour.to_min_area_rect.angle
+        angle = batch.min_area_rects[2]
+        angle = np.where(angle < -45, angle + 90, angle)
+
+        return (self.settings.angle.min <= angle) & (angle <= self.settings.angle.max)
+
+
+def _hypot(centroids: ndarray) -> ndarray:  # Same operations as Point.hypot
+    return ((centroids[:, 0] ** 2) + (centroids[:, 1] ** 2)) ** 0.5
+
+
+def top_k(keys: ndarray, k: int) -> ndarray:
+    """
+    Indices of the k largest keys, largest first. Ties keep their original order,
+    so this matches the first k of sorted(..., reverse=True)
+    """
 
-        if angle < -45:
-            angle += 90
+    if k <= 0:
+        return np.array([], dtype=np.intp)
 
-        return self.settings.angle.min <= angle <= self.settings.angle.max
+    if k >= len(keys):
+        return np.argsort(-keys, kind="stable")
+
+    if k == 1:
+        return np.array([np.argmax(keys)])
+
+    # Partial selection finds the kth largest key without sorting everything
+    kth = keys[np.argpartition(-keys, k - 1)[k - 1]]
+    larger = np.flatnonzero(keys > kth)
+    tied = np.flatnonzero(keys == kth)[: k - len(larger)]
+
+    top = np.concatenate((larger, tied))
+    return top[np.argsort(-keys[top], kind="stable")]
 
 
 class Sort(Function):
+    # Each returns the sort key of every contour in a ContourBatch, largest first
     filters = {
-        "Top": lambda cnt: -cnt.centroid.y,
-        "Bottom": lambda cnt: cnt.centroid.y,
-        "Left": lambda cnt: -cnt.centroid.x,
-        "Right": lambda cnt: cnt.centroid.x,
-        "Center": lambda cnt: -cnt.centroid.hypot,
-        "Largest": lambda cnt: cnt.area,
-        "Smallest": lambda cnt: -cnt.area,
+        "Top": lambda batch: -batch.centroids[:, 1],
+        "Bottom": lambda batch: batch.centroids[:, 1],
+        "Left": lambda batch: -batch.centroids[:, 0],
+        "Right": lambda batch: batch.centroids[:, 0],
+        "Center": lambda batch: -_hypot(batch.centroids),
+        "Largest": lambda batch: batch.areas,
+        "Smallest": lambda batch: -batch.areas,
     }
 
     @dataclass
@@ -206,22 +249,19 @@ class Sort(Function):
         contours: Contours
 
     def run(self, inputs):
-        contours = inputs.contours.l
-        if len(contours) == 0:
+        batch = inputs.contours.batch
+        if len(batch) == 0:
             return self.Outputs(contours=Contours.from_contours([]))
 
-        sort_fn = self.filters[self.settings.by]
-
-        sorted_contours = sorted(contours, key=sort_fn, reverse=True)
+        keys = self.filters[self.settings.by](batch)
 
         if self.settings.keep == "One":
-            contours_out = [sorted_contours[0]]
+            amount = 1
         elif self.settings.keep == "All":
-            contours_out = sorted_contours
-        else:
-            if self.settings.keep_amount > len(sorted_contours):
-                contours_out = sorted_contours
-            else:
-                contours_out = sorted_contours[: self.settings.keep_amount]
+            amount = len(batch)
+        else:  # same amount as slicing the sorted contours with [:keep_amount]
+            amount = len(range(len(batch))[: self.settings.keep_amount])
+
+        contours_out = batch.take(top_k(keys, amount))
 
-        return self.Outputs(contours=Contours.from_contours(contours_out))
+        return self.Outputs(contours=Contours.from_batch(contours_out))
@@ -1,5 +1,6 @@
 from networktables import NetworkTables
 
+from opsi.manager.netdict import NT_PUBLISHER
 from opsi.util.networking import get_nt_server
 
 from .get import GetNT, HookInstance  # sad
@@ -11,6 +12,7 @@ __version__ = "0.123"
 
 def init_networktables():
     network = HookInstance.persist.network
+    NT_PUBLISHER.max_rate = network.nt_max_rate
     if network.nt_enabled:
         if network.nt_client:
             addr = get_nt_server(network)
@@ -20,6 +22,7 @@ def init_networktables():
 
 
 def deinit_networktables():
+    NT_PUBLISHER.stop()
     if HookInstance.persist.network.nt_enabled:
         NetworkTables.shutdown()
 
@@ -13,9 +13,25 @@ HookInstance = Hook()
 
 
 class GetNT(PutNT):
+    @dataclass
+    class Settings:  # Without PutNT's max_items, which only applies to writing
+        path: str = "/OpenSight"
+        key: str = ""
+
     def on_start(self):
+        self.listener = None
         self.table = NetworkDict(self.settings.path)
 
+        # (number of changes, value), replaced whole by the NT listener thread,
+        # so run never needs a lock to read it
+        self.slot = (0, None)
+        self.last_change = 0
+
+        self.listener = self.table.add_listener(self.settings.key, self.update)
+
+    def update(self, value):  # Called on the NT listener thread
+        self.slot = (self.slot[0] + 1, value)
+
     @dataclass
     class Inputs:
         pass
@@ -23,11 +39,19 @@ class GetNT(PutNT):
     @dataclass
     class Outputs:
         val: AnyType = None
+        changed: bool = False  # Whether val changed since the last frame
 
     def run(self, inputs):
-        val = self.table.get(self.settings.key, None)
+        change, val = self.slot
+        changed = change != self.last_change
+        self.last_change = change
+
         if val is None:
             HookInstance.cancel_output("val")
-            return self.Outputs()
+            return self.Outputs(changed=changed)
+
+        return self.Outputs(val=val, changed=changed)
 
-        return self.Outputs(val=val)
+    def dispose(self):
+        if self.listener is not None:
+            self.table.remove_listener(self.listener)
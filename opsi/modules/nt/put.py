@@ -1,12 +1,17 @@
 from dataclasses import dataclass
 
 from opsi.manager.manager_schema import Function
-from opsi.manager.netdict import NetworkDict
+from opsi.manager.netdict import NT_PUBLISHER, NetworkDict, value_factory
 from opsi.manager.types import AnyType
+from opsi.util.cv import Contour, Contours
+from opsi.util.cv.shape import Circles, Segments
 from opsi.util.unduplicator import Unduplicator
 
 UndupeInstance = Unduplicator()
 
+# Types whose nt_serialize can publish only the first few of their points or shapes
+LIMITED_TYPES = (Contour, Contours, Circles, Segments)
+
 
 class PutNT(Function):
     has_sideeffect = True
@@ -40,15 +45,30 @@ class PutNT(Function):
         else:
             return f"{self.settings.key}-{key}"
 
-    # Writes a dictionary of values to network tables
+    # Checked here, as the NT publisher thread can only log what it fails to write
+    @staticmethod
+    def check_value(value):
+        try:
+            value_factory(value)
+        except TypeError as e:
+            raise TypeError(
+                f"Type {value.__class__.__name__} cannot be written to NT: {e}"
+            )
+
+    # Writes a dictionary of values to network tables, on the NT publisher thread
     def write_dict_to_path(self, value_dict):
-        for key, val in value_dict.items():
-            self.table[self.prefixed_key(key)] = val
+        for val in value_dict.values():
+            self.check_value(val)
+
+        NT_PUBLISHER.submit(
+            self.table, {self.prefixed_key(key): val for key, val in value_dict.items()}
+        )
 
     @dataclass
     class Settings:
         path: str = "/OpenSight"
         key: str = ""
+        max_items: int = 0  # Max contours, points, circles or lines to write; 0 for all
 
     @dataclass
     class Inputs:
@@ -59,23 +79,22 @@ class PutNT(Function):
             return self.Outputs()
 
         # If the value has a nt_serialize function, use it.
-        elif hasattr(inputs.val, "nt_serialize") and callable(inputs.val.nt_serialize):
-            values = inputs.val.nt_serialize()
+        if hasattr(inputs.val, "nt_serialize") and callable(inputs.val.nt_serialize):
+            if self.settings.max_items > 0 and isinstance(inputs.val, LIMITED_TYPES):
+                values = inputs.val.nt_serialize(limit=self.settings.max_items)
+            else:
+                values = inputs.val.nt_serialize()
             self.write_dict_to_path(values)
 
         else:  # If the value is in NT_TYPES, write it directly to the key. If this fails, the value cannot be written.
-            try:
-                if self.settings.key:
-                    self.table[self.settings.key] = inputs.val
-                else:
-                    raise ValueError(
-                        "Cannot write types bool, int, float, str, bytes, or lists to NT without "
-                        "a key"
-                    )
-            except TypeError:
-                raise TypeError(
-                    f"Type {inputs.val.__class__.__name__} cannot be written to NT."
+            if not self.settings.key:
+                raise ValueError(
+                    "Cannot write types bool, int, float, str, bytes, or lists to NT without "
+                    "a key"
                 )
+            self.check_value(inputs.val)
+
+            NT_PUBLISHER.submit(self.table, {self.settings.key: inputs.val})
 
         return self.Outputs()
 
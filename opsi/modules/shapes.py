@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 
-from opsi.manager.manager_schema import Function
+from opsi.manager.manager_schema import GREY, Function
+from opsi.manager.types import Slide
 from opsi.util.cv import Mat, MatBW
 from opsi.util.cv.shape import Circles, Segments
 
@@ -9,6 +10,8 @@ __version__ = "0.123"
 
 
 class FindCircles(Function):
+    input_formats = {"img": GREY}  # HoughCircles needs a single channel
+
     @dataclass
     class Settings:
         resolution_divisor: int
@@ -17,6 +20,7 @@ class FindCircles(Function):
         circle_detection_threshold: int
         min_radius: int
         max_radius: int
+        pyramid_levels: Slide(min=0, max=3, decimal=False) = 0
 
     @dataclass
     class Inputs:
@@ -35,6 +39,7 @@ class FindCircles(Function):
                 self.settings.circle_detection_threshold,
                 self.settings.min_radius,
                 self.settings.max_radius,
+                levels=self.settings.pyramid_levels,
             )
         )
 
@@ -46,6 +51,7 @@ class FindLines(Function):
         threshold: int
         min_length: int
         max_gap: int
+        pyramid_levels: Slide(min=0, max=3, decimal=False) = 0
 
     @dataclass
     class Inputs:
@@ -62,5 +68,6 @@ class FindLines(Function):
                 self.settings.threshold,
                 self.settings.min_length,
                 self.settings.max_gap,
+                levels=self.settings.pyramid_levels,
             )
         )
@@ -0,0 +1,60 @@
+from dataclasses import dataclass
+
+from opsi.manager.manager_schema import Function
+from opsi.manager.types import AnyType
+from opsi.util.shm import SharedMemoryWriter
+from opsi.util.unduplicator import Unduplicator
+
+__package__ = "opsi.shm"
+__version__ = "0.123"
+
+UndupeInstance = Unduplicator()
+
+
+# Writes a number, Point, Pose3D or Corners into a shared memory segment every
+# frame, for other processes on the same machine to read with
+# opsi.util.shm.SharedMemoryReader
+class PutSharedMemory(Function):
+    has_sideeffect = True
+
+    @classmethod
+    def validate_settings(cls, settings):
+        settings.name = settings.name.strip()
+
+        if not settings.name or "/" in settings.name:
+            raise ValueError("Name must not be empty or have '/' in it")
+
+        if not 0 <= settings.channel <= 65535:
+            raise ValueError("Channel must be between 0 and 65535")
+
+        return settings
+
+    @dataclass
+    class Settings:
+        name: str = "results"
+        channel: int = 0
+
+    @dataclass
+    class Inputs:
+        val: AnyType
+
+    def on_start(self):
+        self.writer = None
+
+        self.claimed = UndupeInstance.add(self.settings.name)
+        if not self.claimed:
+            raise ValueError("Cannot have duplicate shared memory names")
+
+        self.writer = SharedMemoryWriter(self.settings.name, self.settings.channel)
+
+    def run(self, inputs):
+        # None is written too, so readers know there is no value this frame
+        self.writer.write(inputs.val)
+
+        return self.Outputs()
+
+    def dispose(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.claimed:
+            UndupeInstance.remove(self.settings.name)
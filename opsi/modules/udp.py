@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+
+from opsi.manager.manager_schema import Function, Hook
+from opsi.manager.types import AnyType
+from opsi.util.networking import get_nt_server
+from opsi.util.udp import UDPSender
+
+__package__ = "opsi.udp"
+__version__ = "0.123"
+
+HookInstance = Hook()
+
+
+# Sends a number, Point, Pose3D or Corners as one UDP datagram per frame, see
+# opsi.util.udp for the format. Has less latency than NT, which batches updates
+class PutUDP(Function):
+    has_sideeffect = True
+
+    @classmethod
+    def validate_settings(cls, settings):
+        settings.host = settings.host.strip()
+
+        if not 1 <= settings.port <= 65535:
+            raise ValueError("Port must be between 1 and 65535")
+
+        if not 0 <= settings.channel <= 65535:
+            raise ValueError("Channel must be between 0 and 65535")
+
+        return settings
+
+    @dataclass
+    class Settings:
+        host: str = ""  # Leave empty to send to the robot
+        port: int = 5800
+        channel: int = 0
+
+    @dataclass
+    class Inputs:
+        val: AnyType
+
+    def on_start(self):
+        self.sender = None
+        host = self.settings.host or get_nt_server(HookInstance.persist.network)
+        self.sender = UDPSender(host, self.settings.port, self.settings.channel)
+
+    def run(self, inputs):
+        # None is sent too, so the receiver knows there is no value this frame
+        self.sender.send(inputs.val)
+
+        return self.Outputs()
+
+    def dispose(self):
+        if self.sender is not None:
+            self.sender.close()
@@ -1,12 +1,19 @@
 from dataclasses import dataclass
 
-from opsi.manager.manager_schema import Function
+from opsi.manager.manager_schema import BGR, GREY, Function
 from opsi.util.cv import Mat
 from opsi.util.unduplicator import Unduplicator
 
 from .camhook import CamHook
 from .h264 import ENGINE_AVAIL, EngineManager, H264CameraServer
-from .input import create_capture, get_settings, parse_cammode
+from .input import (
+    SCALES,
+    FrameReader,
+    create_capture,
+    get_settings,
+    parse_cammode,
+    read_frame,
+)
 from .mjpeg import MjpegCameraServer
 
 __package__ = "opsi.videoio"
@@ -16,40 +23,74 @@ UndupeInstance = Unduplicator()
 HookInstance = CamHook()
 if ENGINE_AVAIL:
     EngineInstance = EngineManager(HookInstance)
+    HookInstance.engine = EngineInstance  # For its stats
     HookInstance.add_listener("pipeline_update", EngineInstance.restart_engine)
     HookInstance.add_listener("shutdown", EngineInstance.shutdown)
 
 
 class CameraInput(Function):
-    require_restart = True
+    # Reopening the camera leaves the pipeline without frames for around a second,
+    # so the rest are changed while it is open, see update_settings
+    require_restart = ("mode", "width", "height", "fps")
 
     def on_start(self):
+        self.reader = None
+        self.cap = None
+        self.claimed = False  # The camera, so another CameraInput can't open it
+        self.applied = self.settings
+
         camNum = parse_cammode(self.settings.mode)[0]
         if not UndupeInstance.add(camNum):
             raise ValueError(f"Camera {camNum} already in use")
-        self.cap = create_capture(self.settings)
+        self.claimed = True
+        self.cap, self.codec = create_capture(self.settings)
         ret, frame = self.cap.read()  # test for errors
         try:
-            Mat(frame)
+            read_frame(frame, codec=self.codec)
         except Exception:
             raise ValueError(f"Unable to read picture from Camera {camNum}")
 
+        self.reader = FrameReader(
+            self.cap, SCALES[self.settings.scale], codec=self.codec
+        )
+
     Settings = get_settings()
 
     @dataclass
     class Outputs:
         img: Mat
 
+    def negotiate_formats(self, formats):
+        # Only decode colour if something needs it
+        self.reader.format = GREY if formats.get("img") == {GREY} else BGR
+
+    def update_settings(self):
+        self.reader.set_controls(self.settings, self.applied)
+        self.reader.scale = SCALES[self.settings.scale]
+        self.applied = self.settings
+
     def run(self, inputs):
+        if self.settings != self.applied:
+            self.update_settings()
+
         frame = None
         if self.cap:
-            ret, frame = self.cap.read()
-            frame = Mat(frame)
+            frame = self.reader.read()
+            # Either may have been read before the format was negotiated
+            if self.reader.format == GREY:
+                frame = frame.greyscale
+            else:
+                frame = frame.bgr
         return self.Outputs(img=frame)
 
     def dispose(self):
-        camNum = parse_cammode(self.settings.mode)[0]
-        UndupeInstance.remove(camNum)
+        # The camera is only free for another CameraInput once nothing reads it
+        if self.reader is not None:
+            self.reader.stop()
+        if self.cap is not None:
+            self.cap.release()
+        if self.claimed:
+            UndupeInstance.remove(parse_cammode(self.settings.mode)[0])
 
 
 BACKEND_STRINGS = (
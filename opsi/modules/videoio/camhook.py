@@ -1,19 +1,26 @@
+from itertools import chain
 from pathlib import Path
 
 from jinja2 import Template
-from starlette.routing import Route, Router
+from starlette.responses import JSONResponse
+from starlette.routing import Route, Router, WebSocketRoute
 
 from opsi.manager.manager_schema import Hook
 from opsi.manager.netdict import NT_AVAIL, NetworkDict
+from opsi.manager.pipeline import CalculatedItemPerformance
 from opsi.util.templating import LiteralTemplate
 
-from .mjpeg import MjpegResponse
+from .mjpeg import BandwidthAllocator, MjpegResponse, jpeg_response
+from .websocket import websocket_stream
 
 
 class CamHook(Hook):
     # Matches both "camera.mjpg" and "camera.mjpeg"
     ROUTE_URL = "/{func}.mjpe?g"  # Route to bind to
     STREAM_URL = "/{func}.mjpeg"  # Canonical path
+    SNAPSHOT_URL = "/{func}.jpe?g"  # Latest frame as a single jpg
+    WEBSOCKET_URL = "/{func}.ws"  # Frames as binary messages, see websocket.py
+    STATS_URL = "/stats"  # JSON of get_stats
 
     path = Path(__file__).parent
     with open(path / "mjpeg.html") as f:
@@ -30,19 +37,81 @@ class CamHook(Hook):
         self.app = Router()
         if NT_AVAIL:
             self.netdict = NetworkDict("/CameraPublisher")
-        self.funcs = {}  # {name: route}
+        self.funcs = {}  # {name: (stream route, snapshot route, websocket route)}
+        self.camservs = {}  # {name: func}
+        self.allocator = BandwidthAllocator(self._bandwidth_budget)
+        self.engine = None  # EngineManager, if H.264 is available
         self.cams = {}  # {name: url}
-        self.index_route = [Route("/", LiteralTemplate(self.TEMPLATE, cams=self.cams))]
+        self.index_route = [
+            Route("/", LiteralTemplate(self.TEMPLATE, cams=self.cams)),
+            Route(self.STATS_URL, self.stats_endpoint),
+        ]
         self.listeners = {"startup": set(), "shutdown": set(), "pipeline_update": set()}
 
         self._update()
 
     def _update(self):
-        self.app.routes = self.index_route + list(self.funcs.values())
+        self.app.routes = self.index_route + list(
+            chain.from_iterable(self.funcs.values())
+        )
 
     def endpoint(self, camserv):
         def response(request):
-            return MjpegResponse(request, camserv)
+            return MjpegResponse(request, camserv, self.allocator)
+
+        return response
+
+    def snapshot_endpoint(self, camserv):
+        async def response(request):  # async to run on the event loop, like streams
+            return await jpeg_response(request, camserv)
+
+        return response
+
+    def stats_endpoint(self, request):
+        return JSONResponse(self.get_stats())
+
+    def get_stats(self):
+        stats = {
+            "clients": self.get_client_stats(),
+            "bandwidth": self.get_bandwidth_stats(),
+            "encode": self.get_encode_stats(),
+            "write": self.engine.get_write_stats() if self.engine else {},
+        }
+        for kind in ("encode", "write"):
+            stats[kind] = {name: perf._asdict() for name, perf in stats[kind].items()}
+
+        return stats
+
+    def get_encode_stats(self):
+        # Per stream, measured on its encoder thread
+        stats = {}
+        for name, camserv in self.camservs.items():
+            samples = camserv.src.src.samples()
+            if samples:
+                stats[name] = CalculatedItemPerformance.calculate(samples)
+
+        return stats
+
+    def _bandwidth_budget(self):
+        # Of all streams, in bytes per second
+        if self.persist is None:
+            return 0
+        return self.persist.network.stream_max_mbps * 1e6 / 8
+
+    def get_bandwidth_stats(self):
+        # Budgeted and measured bytes per second of all streams
+        return self.allocator.as_dict()
+
+    def get_client_stats(self):
+        # {name: [stats of each client]}, see ClientStats.as_dict
+        return {
+            name: [client.as_dict() for client in camserv.src.src.clients.copy()]
+            for name, camserv in self.camservs.items()
+        }
+
+    def websocket_endpoint(self, camserv):
+        async def response(websocket):
+            await websocket_stream(websocket, camserv, self.allocator)
 
         return response
 
@@ -50,9 +119,14 @@ class CamHook(Hook):
         if func.id in self.funcs:
             raise ValueError("Cannot have duplicate name")
 
-        self.funcs[func.id] = Route(
-            self.ROUTE_URL.format(func=func.id), self.endpoint(func)
+        self.funcs[func.id] = (
+            Route(self.ROUTE_URL.format(func=func.id), self.endpoint(func)),
+            Route(self.SNAPSHOT_URL.format(func=func.id), self.snapshot_endpoint(func)),
+            WebSocketRoute(
+                self.WEBSOCKET_URL.format(func=func.id), self.websocket_endpoint(func)
+            ),
         )
+        self.camservs[func.id] = func
         self.cams[func.id] = self.CAMERA_URL_WEB.format(url=self.url, func=func.id)
         self._update()
 
@@ -64,6 +138,7 @@ class CamHook(Hook):
     def unregister(self, func):
         try:
             del self.funcs[func.id]
+            del self.camservs[func.id]
             del self.cams[func.id]
         except KeyError:
             pass
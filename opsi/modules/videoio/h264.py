@@ -2,9 +2,17 @@ import json
 import logging
 import shlex
 import subprocess
+import threading
+from collections import deque
+from functools import lru_cache
+from time import perf_counter
 from typing import Tuple
 
+import cv2
+import numpy as np
+
 from opsi.manager.netdict import NT_AVAIL, NetworkDict
+from opsi.manager.pipeline import CalculatedItemPerformance
 from opsi.util.networking import choose_port
 
 LOGGER = logging.getLogger(__name__)
@@ -18,6 +26,20 @@ except ImportError:
     ENGINE_AVAIL = False
 
 
+@lru_cache(maxsize=None)
+def detect_encoder() -> str:
+    # Checked once per process, since gst-inspect is slow to start
+    command = shlex.split("gst-inspect-1.0 omxh264enc")
+    out = subprocess.run(
+        command,
+        env={"PAGER": "cat"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )  # ensure gst-inspect doesn't lock up with more/less
+
+    return "OpenMAX" if not out.returncode else "Software"
+
+
 class EngineManager:
     """
     Manages coordinating a single Engine to be used by every output.
@@ -27,7 +49,9 @@ class EngineManager:
         self._on = False
         self.hook = hook
         self.pipelines = {}
+        self.servers = {}  # {name: H264CameraServer}
         self.engine: engine.Engine = None
+        self.running = {}  # {name: (server, pipeline)} the engine was started with
 
         ports = [554, 1181]
         self.port = choose_port(ports)
@@ -35,10 +59,15 @@ class EngineManager:
             raise ValueError(f"Unable to bind to any of ports {ports}")
 
     def register(self, func: "H264CameraServer"):
-        if func.name in self.pipelines:
+        # A server registers again when its size changes
+        if self.servers.get(func.name, func) is not func:
             raise ValueError("Cannot have duplicate name")
+        again = func.name in self.servers
         pipeline = func.pipeline
         self.pipelines[func.name] = pipeline
+        self.servers[func.name] = func
+        if again and self.engine:  # Not waiting for the next pipeline update
+            self.restart_engine()
         if NT_AVAIL:
             url = self.hook.url.split("/")[2].split(":")[0]
             port = "" if self.port == 554 else ":{self.port}"
@@ -49,6 +78,7 @@ class EngineManager:
     def unregister(self, func: "H264CameraServer"):
         try:
             del self.pipelines[func.name]
+            del self.servers[func.name]
             if NT_AVAIL:
                 NetworkDict("/GStreamer").delete(func.name)
         except KeyError:
@@ -63,17 +93,44 @@ class EngineManager:
         self._on = True
 
     def restart_engine(self):
+        # The engine is given every pipeline when it starts, and can't change them
+        # while running. So it is only restarted if they changed, or if a server
+        # was replaced, as its writer opens a new socket
+        running = {
+            name: (self.servers[name], pipeline)
+            for name, pipeline in self.pipelines.items()
+        }
+        if running == self.running:
+            return
+
         if self.engine:
             self.engine.stop()
+            self.engine = None
+        self.running = running
         if len(self.pipelines) > 0:
             self.start()
 
     def shutdown(self):
         if self.engine:
             self.engine.stop()
+            self.engine = None
+        self.running = {}
+
+    def get_write_stats(self):
+        # Per stream, seconds to hand each frame to the engine
+        stats = {}
+        for name, server in self.servers.items():
+            samples = server.samples()
+            if samples:
+                stats[name] = CalculatedItemPerformance.calculate(samples)
+
+        return stats
 
 
 class H264CameraServer:
+    SAMPLES = 100
+    RING_SIZE = 3  # Frames converted for the engine, see frame_for
+
     def __init__(self, name: str, fps: int):
         self.name = name
         self.fps = fps
@@ -81,11 +138,23 @@ class H264CameraServer:
         self.engine: engine.GStreamerEngineWriter = None
         self.registered: bool = False
 
+        self.ring = None  # Allocated once the size is known
+        self.ring_index = 0
+
+        self._write_times = deque(maxlen=self.SAMPLES)
+        self._samples_lock = threading.Lock()  # Samples are read by the webserver
+
     def run(self, inputs: "CameraServer.Inputs"):
+        img = inputs.img.mat.img
+        if self.engine is not None and img.shape[1::-1] != self.size[:2]:
+            # The engine is told the size, so register again with the new one
+            self.dispose()
+            self.engine = None
+            self.registered = False
+
         if self.engine is None:
             # we need to set up engine
-            shape = inputs.img.img.shape
-            self.size: Tuple[int, int, int] = (shape[1], shape[0], self.fps)
+            self.size: Tuple[int, int, int] = (img.shape[1], img.shape[0], self.fps)
             self.engine = engine.GStreamerEngineWriter(
                 socket_path=self.shmem_socket,
                 video_size=self.size,
@@ -93,9 +162,43 @@ class H264CameraServer:
                 autostart=False,
             )
             return
+
+        start = perf_counter()
+        self.engine.write_frame(self.frame_for(img))
+        with self._samples_lock:
+            self._write_times.append(perf_counter() - start)
+
+    def frame_for(self, img: np.ndarray) -> np.ndarray:
+        """
+        The engine takes contiguous BGR frames of the size it was set up with,
+        and keeps a reference to the last one until its own thread copies it.
+        Frames that are already like that are passed as they are, since Mats are
+        not changed once made. Others are converted into the next buffer of a
+        ring allocated once, which is not reused until the engine is done with it
+        """
+
+        width, height = self.size[:2]
+        shape = (height, width, 3)
+        if img.shape == shape and img.flags.c_contiguous:
+            return img
+
+        if self.ring is None:
+            self.ring = [np.empty(shape, np.uint8) for _ in range(self.RING_SIZE)]
+        buffer = self.ring[self.ring_index]
+        self.ring_index = (self.ring_index + 1) % self.RING_SIZE
+
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        if img.shape != shape:
+            cv2.resize(img, (width, height), dst=buffer)
         else:
-            img = inputs.img.mat.img
-            self.engine.write_frame(img)
+            np.copyto(buffer, img)
+
+        return buffer
+
+    def samples(self):  # Seconds per write
+        with self._samples_lock:
+            return list(self._write_times)
 
     def dispose(self):
         if self.engine:
@@ -119,15 +222,7 @@ class H264CameraServer:
 
     @property
     def encoder(self):
-        command = shlex.split("gst-inspect-1.0 omxh264enc")
-        out = subprocess.run(
-            command,
-            env={"PAGER": "cat"},
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )  # ensure gst-inspect doesn't lock up with more/less
-
-        return "OpenMAX" if not out.returncode else "Software"
+        return detect_encoder()
 
     @property
     def pipeline(self):
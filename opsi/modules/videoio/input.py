@@ -2,10 +2,16 @@ import glob
 import logging
 import re
 import subprocess
+import threading
 from dataclasses import dataclass
 from sys import platform
+from time import perf_counter, sleep
 
 import cv2
+import numpy as np
+
+from opsi.manager.manager_schema import BGR, GREY
+from opsi.util.cv import Mat
 
 LOGGER = logging.getLogger(__name__)
 
@@ -16,6 +22,10 @@ ENABLE_FPS = False
 IS_LINUX = platform.startswith("linux")
 
 
+# Fraction of the camera's resolution to output, see read_frame
+SCALES = {"1": 1, "1/2": 2, "1/4": 4, "1/8": 8}
+
+
 def get_settings():
     @dataclass
     class Linux:
@@ -27,6 +37,7 @@ def get_settings():
         width: controls() = None
         height: controls() = None
         fps: controls(True) = None
+        scale: tuple(SCALES) = "1"
 
     @dataclass
     class NonLinux:
@@ -38,6 +49,7 @@ def get_settings():
         width: int = 320
         height: int = 240
         fps: int = 60
+        scale: tuple(SCALES) = "1"
 
     return Linux if IS_LINUX else NonLinux
 
@@ -53,6 +65,9 @@ CODECS_LIST = tuple(
     (codec[0], codec[1], cv2.VideoWriter_fourcc(*codec[2])) for codec in CODECS_LIST
 )
 
+MJPG_FOURCC = cv2.VideoWriter_fourcc(*"MJPG")
+YUYV_FOURCC = cv2.VideoWriter_fourcc(*"YUYV")
+
 CODEC_REGEX = (
     r"\[\d+\]: '{codec_name}' \({codec_regex}\) (.+)\[\d+\].+",
     r"\[\d+\]: '{codec_name}' \({codec_regex}\) (.+)$",
@@ -180,6 +195,8 @@ def controls(fps=False):
 
 
 def create_capture(settings):
+    # Returns the capture, and the codec its frames are read in: MJPG_FOURCC or
+    # YUYV_FOURCC when OpenCV leaves them as the camera sent them, otherwise None
     def set_property(prop, value):
         try:
             cap.set(prop, value)
@@ -189,13 +206,18 @@ def create_capture(settings):
     mode = parse_cammode(settings.mode)
 
     if len(mode) < 1:
-        return None
+        return None, None
 
+    raw = None
     if IS_LINUX:
         cap = cv2.VideoCapture(mode[0], cv2.CAP_V4L)
         codec = get_codec(get_cam_info(mode[0]))
         if codec:
             set_property(cv2.CAP_PROP_FOURCC, codec[0])
+            if codec[0] in (MJPG_FOURCC, YUYV_FOURCC):
+                # Read frames as the camera sent them, see read_frame
+                set_property(cv2.CAP_PROP_CONVERT_RGB, 0)
+                raw = codec[0]
     else:
         cap = cv2.VideoCapture(mode[0])
 
@@ -213,9 +235,140 @@ def create_capture(settings):
     set_property(cv2.CAP_PROP_FPS, fps)
 
     set_property(cv2.CAP_PROP_AUTO_EXPOSURE, 1)  # disable auto-exposure, unintuitively
-    set_property(cv2.CAP_PROP_BRIGHTNESS, settings.brightness)
-    set_property(cv2.CAP_PROP_CONTRAST, settings.contrast)
-    set_property(cv2.CAP_PROP_SATURATION, settings.saturation)
-    set_property(cv2.CAP_PROP_EXPOSURE, settings.exposure)
+    set_controls(cap, settings)
+
+    return cap, raw
+
 
-    return cap
+# Settings which are applied to the open camera when changed, see set_controls
+CONTROLS = {
+    "brightness": cv2.CAP_PROP_BRIGHTNESS,
+    "contrast": cv2.CAP_PROP_CONTRAST,
+    "saturation": cv2.CAP_PROP_SATURATION,
+    "exposure": cv2.CAP_PROP_EXPOSURE,
+}
+
+
+def set_controls(cap, settings, previous=None) -> float:
+    """
+    Sets the controls that differ from previous, or all of them without it, and
+    reads each back to check the camera took it. Returns the seconds taken
+    """
+
+    start = perf_counter()
+    for name, prop in CONTROLS.items():
+        value = getattr(settings, name)
+        if previous is not None and getattr(previous, name) == value:
+            continue
+
+        if not cap.set(prop, value):
+            LOGGER.debug("Camera does not support property %s", name)
+        elif cap.get(prop) != value:
+            LOGGER.debug("Camera set %s to %s, not %s", name, cap.get(prop), value)
+
+    return perf_counter() - start
+
+
+def read_frame(frame, scale: int = 1, format: str = BGR, codec: int = None) -> Mat:
+    # With CAP_PROP_CONVERT_RGB off, see create_capture, an MJPG frame is read as
+    # a single row of bytes, and is decoded here instead, at the scale and format
+    # asked for
+    if codec == MJPG_FOURCC:
+        return Mat.from_jpg(frame, scale, grey=format == GREY)
+
+    # and YUYV is read as two channels: luma, then alternating blue and red chroma
+    if codec == YUYV_FOURCC:
+        if format == GREY:
+            frame = np.ascontiguousarray(frame[:, :, 0])
+        else:
+            frame = cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_YUYV)
+
+    if scale > 1:
+        height, width = frame.shape[:2]
+        size = (max(1, width // scale), max(1, height // scale))
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    if format == GREY and frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return Mat(frame)
+
+
+class FrameReader:
+    """
+    Reads and decodes frames on its own thread, so the next frame is decoded
+    while the pipeline works on the last one. Only the latest frame is kept, so
+    a slow pipeline gets the newest frame rather than falling behind.
+    VideoCapture is not thread-safe, so controls are changed on this thread too,
+    between reads, see set_controls
+    """
+
+    TIMEOUT = 2  # Seconds to wait for a frame before giving up
+    RETRY_INTERVAL = 0.1  # Seconds between reads, while they fail
+
+    def __init__(self, cap, scale: int = 1, format: str = BGR, codec: int = None):
+        self.cap = cap
+        self.codec = codec  # As returned by create_capture
+        self.scale = scale
+        self.format = format  # Can be changed while running
+
+        self._result = None  # Mat, or the exception reading it raised
+        self._sequence = 0  # Of _result
+        self._taken = 0  # Sequence of the last result read() returned
+        self._controls = None  # (settings, previous) waiting to be set
+        self._condition = threading.Condition()
+        self._running = True
+
+        self._thread = threading.Thread(
+            target=self._run, name="Camera reader", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            with self._condition:
+                controls, self._controls = self._controls, None
+            if controls is not None:
+                took = set_controls(self.cap, *controls)
+                LOGGER.info("Updated camera controls in %.1fms", took * 1000)
+
+            try:
+                ret, frame = self.cap.read()
+                if not ret:
+                    raise ValueError("Unable to read picture from camera")
+                result = read_frame(frame, self.scale, self.format, self.codec)
+            except Exception as e:
+                result = e
+
+            with self._condition:
+                self._result = result
+                self._sequence += 1
+                self._condition.notify_all()
+
+            if isinstance(result, Exception):
+                sleep(self.RETRY_INTERVAL)
+
+    def read(self) -> Mat:
+        # The next frame after the last one read, raising if it could not be read
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self._sequence > self._taken, self.TIMEOUT
+            ):
+                raise ValueError("Timed out reading picture from camera")
+
+            self._taken = self._sequence
+            result = self._result
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def set_controls(self, settings, previous):
+        # Sets them before the next read, see set_controls
+        with self._condition:
+            if self._controls is not None:  # Not set yet, so still the previous
+                previous = self._controls[1]
+            self._controls = (settings, previous)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
@@ -1,9 +1,13 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Tuple
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+from typing import Dict, Hashable, NamedTuple, Optional, Tuple
 
 from pydantic import BaseModel, Field, ValidationError, validator
+from starlette.responses import Response
 
 from opsi.util.asgi import ASGIStreamer
 from opsi.util.cv import Point
@@ -79,72 +83,527 @@ class Params(BaseModel):
     fps: int = Field(30, gt=0)
     resolution: Tuple[int, int] = None  # actually type: Point
 
+    @property
+    def quality(self):
+        return 100 - self.compression
+
+    @property
+    def as_sent(self) -> bool:
+        # If frames can be sent as they came from the camera, see Sink.get_jpg
+        return self.resolution is None and "compression" not in self.__fields_set__
+
+
+# Adapts a client's jpg quality, resolution and frame rate to how fast it takes
+# frames, and to its share of the bandwidth budget (see BandwidthAllocator).
+#
+# A send which waits for the client is backpressure: quality is lowered in
+# steps, then the frame rate. A budget caps the frame rate at what it affords,
+# and quality, then resolution, are lowered rather than letting that fall under
+# BUDGET_FPS. After some time without backpressure, each steps back up in the
+# reverse order, up to what the client asked for, if the budget still affords it.
+class AdaptiveRate:
+    QUALITY_STEP = 10  # Coarse, so clients are likely to share encodes
+    MIN_QUALITY = 20
+    MAX_SCALE = 4  # Most the resolution is divided by, in factors of 2
+    MIN_FPS = 1
+    FPS_STEP = 1.25  # Factor
+    RECOVER_AFTER = 1  # Seconds without backpressure before each step up
+
+    BUDGET_FPS = 10
+    # Roughly how much bigger a jpg gets per step up, to not step up only to
+    # step back down again
+    QUALITY_GROWTH = 1.25
+    SCALE_GROWTH = 4  # The area doubles in each direction
+
+    def __init__(self, quality, fps):
+        self.max_quality = self.quality = quality
+        self.max_fps = self.fps = fps  # fps is the limit under backpressure
+        self.scale = 1
+
+        self.budget = 0  # Bytes per second, 0 for no limit
+        self.frame_bytes = 0.0  # Moving average, of the current quality and scale
+
+        self._recovered = None  # When the last backpressure or step up was
+        self._stepped = False  # If frame_bytes is from before a step
+
+    @property
+    def budget_fps(self):
+        if not (self.budget and self.frame_bytes):
+            return float("inf")
+        return self.budget / self.frame_bytes
+
+    @property
+    def interval(self):
+        return 1 / min(self.fps, self.budget_fps)
+
+    @property
+    def constrained(self) -> bool:
+        # If it would send more with more bandwidth
+        return (
+            self.quality < self.max_quality
+            or self.scale > 1
+            or self.budget_fps < self.max_fps
+        )
+
+    def resolution(self, asked: Point, native: Point):
+        # Of frames to send, given what was asked for and the frame's
+        if self.scale == 1:
+            return asked
+        width, height = asked or native
+        return Point(max(1, width // self.scale), max(1, height // self.scale))
+
+    def set_limits(self, quality, fps):
+        # Of what the client asks for, starting from them again
+        self.max_quality = self.quality = quality
+        self.max_fps = self.fps = fps
+        self._stepped = True
+
+    def _step_quality(self, step):
+        self.quality += step
+        self._stepped = True
+
+    def _set_scale(self, scale):
+        self.scale = scale
+        self._stepped = True
+
+    def update(self, now, waited, size) -> bool:
+        # Takes the seconds the last send waited and its bytes, and returns if
+        # it was backpressure
+        if self._recovered is None:
+            self._recovered = now
+
+        if self._stepped or not self.frame_bytes:
+            self.frame_bytes = size
+            self._stepped = False
+        else:
+            self.frame_bytes = (self.frame_bytes + size) / 2
+
+        if waited > self.interval / 2:
+            self._recovered = now
+            if self.quality - self.QUALITY_STEP >= self.MIN_QUALITY:
+                self._step_quality(-self.QUALITY_STEP)
+            else:
+                self.fps = max(self.MIN_FPS, self.fps / self.FPS_STEP)
+            return True
+
+        target = min(self.BUDGET_FPS, self.max_fps)
+        if self.budget_fps < target:
+            if self.quality - self.QUALITY_STEP >= self.MIN_QUALITY:
+                self._step_quality(-self.QUALITY_STEP)
+            elif self.scale < self.MAX_SCALE:
+                self._set_scale(self.scale * 2)
+        elif now - self._recovered >= self.RECOVER_AFTER:
+            self._recovered = now
+            if self.fps < self.max_fps:
+                self.fps = min(self.max_fps, self.fps * self.FPS_STEP)
+            elif self.scale > 1 and self.budget_fps / self.SCALE_GROWTH >= target:
+                self._set_scale(self.scale // 2)
+            elif (
+                self.quality < self.max_quality
+                and self.budget_fps / self.QUALITY_GROWTH >= target
+            ):
+                self._step_quality(self.QUALITY_STEP)
+
+        return False
+
+
+class ClientStats:
+    # Of one client of a stream. Rates are over about a second, up to the last
+    # frame sent. Only changed on the event loop, but read from anywhere
+    WINDOW = 1
+
+    def __init__(self, client: str, rate: AdaptiveRate):
+        self.client = client
+        self.rate = rate
+
+        self.frames = 0
+        self.bytes = 0
+        self.drops = 0  # Frames skipped while the client was not keeping up
+
+        self.fps = 0.0
+        self.bytes_per_second = 0.0
+        self._window = None  # (start, frames, bytes)
+
+    def sent(self, now, size, drops):
+        self.frames += 1
+        self.bytes += size
+        self.drops += drops
+
+        if self._window is None:
+            self._window = (now, self.frames, self.bytes)
+
+        start, frames, size = self._window
+        elapsed = now - start
+        if elapsed >= self.WINDOW:
+            self.fps = (self.frames - frames) / elapsed
+            self.bytes_per_second = (self.bytes - size) / elapsed
+            self._window = (now, self.frames, self.bytes)
+
+    def as_dict(self):
+        return {
+            "client": self.client,
+            "fps": self.fps,
+            "bytes_per_second": self.bytes_per_second,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "drops": self.drops,
+            "quality": self.rate.quality,
+            "scale": self.rate.scale,
+            "max_fps": min(self.rate.fps, self.rate.budget_fps),
+            "budget": self.rate.budget,
+        }
+
+
+def share_bandwidth(budget, demands: Dict[Hashable, float]) -> Dict[Hashable, float]:
+    # Max-min fair shares: the smallest demands are met, and the rest split evenly
+    shares = {}
+    remaining = budget
+    ordered = sorted(demands.items(), key=lambda item: item[1])
+    for i, (key, demand) in enumerate(ordered):
+        shares[key] = min(demand, remaining / (len(ordered) - i))
+        remaining -= shares[key]
+
+    return shares
+
+
+# Divides a budget between the clients of all streams, which AdaptiveRate then
+# keeps to. Runs on the event loop, as streams send frames
+class BandwidthAllocator:
+    INTERVAL = 1  # Seconds between allocations, besides when clients come and go
+    HEADROOM = 1.25  # Over what unconstrained clients use, to let them grow
+
+    def __init__(self, get_budget):
+        self.get_budget = get_budget  # Returns bytes per second, 0 for no limit
+        self.budget = 0
+        self.clients = set()  # ClientStats
+
+        self._allocated = float("-inf")
+
+    def add(self, client: ClientStats):
+        self.clients.add(client)
+        self._allocated = float("-inf")
+
+    def remove(self, client: ClientStats):
+        self.clients.discard(client)
+        self._allocated = float("-inf")
+
+    def update(self, now):
+        if now - self._allocated < self.INTERVAL:
+            return
+        self._allocated = now
+
+        self.budget = self.get_budget()
+        if not self.budget:
+            for client in self.clients:
+                client.rate.budget = 0
+            return
+
+        demands = {}
+        for client in self.clients:
+            rate = client.rate
+            if rate.constrained or not rate.frame_bytes:
+                demands[client] = float("inf")
+            else:
+                demands[client] = rate.frame_bytes * rate.max_fps * self.HEADROOM
+
+        for client, share in share_bandwidth(self.budget, demands).items():
+            client.rate.budget = share
+
+    def as_dict(self):
+        # Bytes per second
+        clients = self.clients.copy()
+        return {
+            "budget": self.budget,
+            "allocated": sum(client.rate.budget for client in clients),
+            "measured": sum(client.bytes_per_second for client in clients),
+        }
+
+
+def client_name(connection) -> str:
+    # Of a starlette Request or WebSocket
+    client = connection.client
+    return f"{client[0]}:{client[1]}" if client else ""
+
+
+# Sends one client the latest frames of a Sink, as fast as the client and its
+# share of the bandwidth budget allow. Frames which come while the client is
+# busy are dropped, not queued
+class FrameStream:
+    def __init__(self, sink, params: Params, allocator: BandwidthAllocator, client):
+        self.sink = sink
+        self.params = params
+        self.allocator = allocator
+
+        self.rate = AdaptiveRate(params.quality, params.fps)
+        self.stats = ClientStats(client, self.rate)
+        self.ended = False
+
+    def set_params(self, params: Params):
+        self.params = params
+        self.rate.set_limits(params.quality, params.fps)
+
+    def end(self):
+        # Makes run return, if it is waiting for a frame
+        self.ended = True
+        self.sink.wake()
+
+    async def run(self, send):
+        # Until end() or the sink ends. Calls send(jpg, drops) for each frame,
+        # which returns the seconds it waited for the client
+        loop = asyncio.get_running_loop()
+        sink, rate, stats = self.sink, self.rate, self.stats
+
+        sink.clients.add(stats)
+        self.allocator.add(stats)
+        try:
+            sequence = 0  # Of the last frame sent
+            sent = float("-inf")
+            congested = False
+            while True:
+                delay = sent + rate.interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                if not await sink.wait_frame(sequence, lambda: self.ended):
+                    return
+
+                resolution = rate.resolution(self.params.resolution, sink.frame.res)
+                quality = rate.quality
+                if self.params.as_sent and resolution is None:
+                    if quality == rate.max_quality:
+                        quality = None
+
+                jpg = await sink.get_jpg(resolution, quality)
+                if jpg is None:  # The sink ended
+                    return
+                if jpg.sequence <= sequence:  # Joined an encode of a frame already sent
+                    continue
+
+                drops = jpg.sequence - sequence - 1 if congested and sequence else 0
+                sequence = jpg.sequence
+
+                # Paced from the start of sends, so time spent waiting for the
+                # client counts towards the interval
+                sent = loop.time()
+                waited = await send(jpg, drops)
+                congested = rate.update(sent, waited, len(jpg.data))
+                stats.sent(sent, len(jpg.data), drops)
+                self.allocator.update(sent)
+        finally:
+            sink.clients.discard(stats)
+            self.allocator.remove(stats)
+
 
-# An ASGI application that streams mjpeg from a jpg iterable
+# An ASGI application that streams mjpeg from a Sink
 class MjpegResponse:
     HEADERS = ASGIStreamer._encode_bytes("Content-Type: image/jpeg\r\n\r\n")
 
-    def __init__(self, request, camserv):
+    def __init__(self, request, camserv, allocator: BandwidthAllocator):
         self.request = request
         self.camserv = camserv
+        self.allocator = allocator
 
     async def __call__(self, scope, receive, send):
-        # call app.send(self.HEADERS + frame) to send frame
+        # call app.send(frame, self.HEADERS) to send frame
         sink = self.camserv.src.src
         query = dict(self.request.query_params)
         params = Params.create(query)
 
         # LOGGER.debug("Parsed params: %r -> %r", query, params)
 
+        stream = FrameStream(sink, params, self.allocator, client_name(self.request))
+
         async with ASGIStreamer(receive, send) as app:
-            while True:
-                if app.end or sink.end:
-                    return
+            # Stop waiting for frames when the client leaves
+            end = asyncio.ensure_future(app.wait_end())
+            end.add_done_callback(lambda _: stream.end())
 
-                if not sink.pendingFrame:
-                    await asyncio.sleep(0.01)
-                    continue
+            async def send_jpg(jpg, drops):
+                return await app.send(jpg.data, self.HEADERS)
+
+            await stream.run(send_jpg)
 
-                frame = sink.frame
-                res = params.resolution
-                if res:
-                    frame = frame.resize(res)
-                frame = frame.encode_jpg(100 - params.compression)
-                await app.send(self.HEADERS + frame)
 
-                time = sink.next_frame_time(params.fps)
-                if time > 0:
-                    await asyncio.sleep(time)
+# Responds with the latest frame as a single jpg
+async def jpeg_response(request, camserv):
+    sink = camserv.src.src
+    params = Params.create(dict(request.query_params))
+
+    if sink.end or not sink.sequence:
+        return Response(status_code=503)
+
+    quality = None if params.as_sent else params.quality
+    jpg = await sink.get_jpg(params.resolution, quality)
+    if jpg is None:
+        return Response(status_code=503)
+    return Response(
+        jpg.data, media_type="image/jpeg", headers={"Cache-Control": "no-store"}
+    )
 
 
 # -----------------------------------------------------------------------------
 
 
+class Jpg(NamedTuple):
+    sequence: int
+    timestamp: float  # Seconds since the epoch when the frame got to the Sink
+    data: bytes
+
+
 class Sink:
+    SAMPLES = 100
+
     def __init__(self):
-        self.pendingFrame = False
-        self.lastTime = datetime.now()
         self.end = False
 
-        self._frame = None
+        # (sequence, timestamp, frame), set together. The sequence counts frames,
+        # from 1, and the timestamp is when the frame got here
+        self._latest = (0, 0.0, None)
+
+        # Streams wait on the condition for new frames. asyncio is not thread
+        # safe, so the pipeline thread wakes them with call_soon_threadsafe, and
+        # only if any are waiting
+        self._loop = None
+        self._condition = None
+        self._waiters = 0
+
+        self.clients = set()  # ClientStats of each stream, changed on the event loop
+
+        # (sequence, {(resolution, quality): Jpg}) of frames already encoded, so
+        # clients with the same parameters share one encode per frame.
+        # Only used from the event loop, like _pending
+        self._encoded = (0, {})
+        self._pending = {}  # {(resolution, quality): future of Jpg}
+
+        # Resizing and encoding happens here, to keep the event loop free
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="MJPEG encoder")
+        self._encode_times = deque(maxlen=self.SAMPLES)  # Seconds per encode
+        self._samples_lock = threading.Lock()
+
+    @property
+    def sequence(self) -> int:  # 0 before the first frame
+        return self._latest[0]
 
     @property
     def frame(self):
-        self.lastTime = datetime.now()
-        return self._frame
+        return self._latest[2]
 
+    # Pipeline thread
     @frame.setter
     def frame(self, frame):
-        self._frame = frame
-        self.pendingFrame = True
+        self._latest = (self._latest[0] + 1, time(), frame)
+        self._wake_threadsafe()
 
-    def next_frame_time(self, fps):
-        return (
-            (self.lastTime + timedelta(seconds=1 / fps)) - datetime.now()
-        ).total_seconds()
+    def _wake_threadsafe(self):
+        # _waiters is counted before wait_frame checks the sequence, which is set
+        # before this, so either it sees the new frame or it is woken
+        if self._waiters:
+            try:
+                self._loop.call_soon_threadsafe(self.wake)
+            except RuntimeError:  # Loop closed
+                pass
+
+    # Event loop
+
+    def wake(self) -> None:
+        # Makes wait_frame check again
+        if self._condition is not None:
+            asyncio.ensure_future(self._notify_all())
+
+    async def _notify_all(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def wait_frame(self, sequence: int, stop=lambda: False) -> int:
+        # Waits for a frame newer than sequence and returns the latest sequence,
+        # or 0 if the sink or stop() ended first. Call wake() to check stop again
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+
+        self._waiters += 1
+        try:
+            async with self._condition:
+                await self._condition.wait_for(
+                    lambda: self.end or stop() or self._latest[0] > sequence
+                )
+        finally:
+            self._waiters -= 1
+
+        if self.end or stop():
+            return 0
+        return self._latest[0]
+
+    async def get_jpg(self, resolution, quality) -> Optional["Jpg"]:
+        # Of the latest frame, or None once the sink has ended. With no resolution
+        # or quality, a frame which was a jpg from the camera is sent as it is, and
+        # others use the default quality
+        if self.end:
+            return None
+        key = (resolution, quality)
+
+        encoded_sequence, encoded = self._encoded
+        if encoded_sequence == self._latest[0] and key in encoded:
+            return encoded[key]
+
+        # Clients asking while an encode is running get its result, rather than
+        # queueing another one
+        future = self._pending.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            try:
+                future = loop.run_in_executor(self._executor, self._encode, key)
+            except RuntimeError:  # Shut down by dispose on the pipeline thread
+                return None
+            future.add_done_callback(lambda future: self._encoded_jpg(key, future))
+            self._pending[key] = future
+
+        # Shielded, so a client leaving does not cancel it for the others
+        return await asyncio.shield(future)
+
+    # Encoder thread
+    def _encode(self, key):
+        # The frame is the latest one when the encode starts, not when it was asked
+        # for, so a slow encoder skips frames instead of falling behind
+        sequence, timestamp, frame = self._latest
+        resolution, quality = key
+
+        start = perf_counter()
+        if resolution:
+            frame = frame.resize(resolution)
+        if quality is None:
+            jpg = frame.jpg or frame.encode_jpg(Params().quality)
+        else:
+            jpg = frame.encode_jpg(quality)
+        with self._samples_lock:
+            self._encode_times.append(perf_counter() - start)
+
+        return Jpg(sequence, timestamp, jpg)
+
+    def _encoded_jpg(self, key, future):
+        del self._pending[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        jpg = future.result()
+        sequence = jpg.sequence
+        encoded_sequence, encoded = self._encoded
+        if sequence < encoded_sequence:  # A newer frame is already cached
+            return
+        if sequence > encoded_sequence:
+            encoded = {}
+            self._encoded = (sequence, encoded)
+        encoded[key] = jpg
+
+    def samples(self):  # Seconds per encode
+        with self._samples_lock:
+            return list(self._encode_times)
 
     def dispose(self):
         self.end = True
+        self._wake_threadsafe()
+        self._executor.shutdown(wait=False)
 
 
 class MjpegCameraServer:
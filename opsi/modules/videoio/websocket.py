@@ -0,0 +1,71 @@
+import asyncio
+import json
+import logging
+import struct
+from time import perf_counter, time
+
+from .mjpeg import BandwidthAllocator, FrameStream, Params, client_name
+
+LOGGER = logging.getLogger(__name__)
+
+# Each frame is one binary message: a little endian header, the node id, and
+# then the jpg. Clients can change their parameters (see mjpeg.Params) at any
+# time by sending them as a JSON text message, such as {"fps": 15}.
+#
+#   offset  type     field
+#   0       uint32   sequence of the frame, counting from 1
+#   4       uint32   frames dropped since the last one sent, as the client was
+#                    not keeping up
+#   8       float64  timestamp, seconds since the epoch when the frame got to
+#                    the CameraServer
+#   16      float64  seconds since the epoch when this was sent
+#   24      uint8    length of the node id
+#   25      char[]   node id, utf-8
+#   ...     jpg
+
+FRAME_HEADER = struct.Struct("<IIddB")
+
+
+async def websocket_stream(websocket, camserv, allocator: BandwidthAllocator):
+    sink = camserv.src.src
+    params = Params.create(dict(websocket.query_params))
+    node_id = camserv.id.encode()[:255]
+
+    await websocket.accept()
+
+    stream = FrameStream(sink, params, allocator, client_name(websocket))
+
+    async def receive():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+            try:
+                query = json.loads(message.get("text") or "")
+                if not isinstance(query, dict):
+                    raise ValueError("Parameters must be a JSON object")
+            except ValueError as e:
+                LOGGER.info("Ignoring invalid parameters: %s", e)
+                continue
+
+            stream.set_params(Params.create(query))
+
+    async def send_jpg(jpg, drops):
+        start = perf_counter()
+        header = FRAME_HEADER.pack(
+            jpg.sequence, drops, jpg.timestamp, time(), len(node_id)
+        )
+        await websocket.send_bytes(b"".join((header, node_id, jpg.data)))
+        return perf_counter() - start
+
+    receiver = asyncio.ensure_future(receive())
+    receiver.add_done_callback(lambda _: stream.end())
+    try:
+        await stream.run(send_jpg)
+    finally:
+        client_left = receiver.done()
+        receiver.cancel()
+
+    if not client_left:  # The CameraServer was disposed
+        await websocket.close()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from opsi.manager.types import Range
+from opsi.modules import contour_filters as filters
+
+from .util import noisy_contours
+
+
+def run(func_type, contours, **settings):
+    func = func_type(func_type.Settings(**settings))
+    return func.run(func_type.Inputs(contours=contours)).contours
+
+
+def raws(contours):
+    return [cnt.raw.tolist() for cnt in contours.l]
+
+
+def test_filter_chain_matches_per_contour_checks():
+    contours = noisy_contours(seed=2, shape=(240, 320))
+
+    out = run(filters.AreaFilter, contours, min_area_pct=0.01, max_area_pct=5)
+    out = run(filters.AspectRatioFilter, out, aspect_ratio_min=1, aspect_ratio_max=3)
+    out = run(filters.OrientationFilter, out, orientation="Vertical")
+    out = run(filters.AngleFilter, out, angle=Range(-30, 30))
+
+    def check(cnt):
+        dim = cnt.to_min_area_rect.dim
+        angle = cnt.to_min_area_rect.angle
+        angle = angle + 90 if angle < -45 else angle
+        return (
+            0.01 < cnt.area * 100 < 5
+            and 1 < max(dim) / min(dim) < 3
+            and -45 <= cnt.to_min_area_rect.vertical_angle <= 45
+            and -30 <= angle <= 30
+        )
+
+    expected = [cnt.raw.tolist() for cnt in contours.l if check(cnt)]
+
+    assert 0 < len(expected) < len(contours.l)
+    assert raws(out) == expected
+    assert out.res == contours.res
+
+
+@pytest.mark.parametrize("by", list(filters.Sort.filters))
+@pytest.mark.parametrize("keep,amount", [("One", 0), ("All", 0), ("Number", 5)])
+def test_sort_matches_sorted(by, keep, amount):
+    contours = noisy_contours(seed=3)
+
+    out = run(filters.Sort, contours, by=by, keep=keep, keep_amount=amount)
+
+    keys = {
+        "Top": lambda cnt: -cnt.centroid.y,
+        "Bottom": lambda cnt: cnt.centroid.y,
+        "Left": lambda cnt: -cnt.centroid.x,
+        "Right": lambda cnt: cnt.centroid.x,
+        "Center": lambda cnt: -cnt.centroid.hypot,
+        "Largest": lambda cnt: cnt.area,
+        "Smallest": lambda cnt: -cnt.area,
+    }
+    expected = sorted(contours.l, key=keys[by], reverse=True)
+    expected = expected[: {"One": 1, "All": len(expected), "Number": amount}[keep]]
+
+    assert raws(out) == [cnt.raw.tolist() for cnt in expected]
+
+
+def test_top_k_keeps_tie_order():
+    keys = np.array([1.0, 3.0, 2.0, 3.0, 2.0, 2.0])
+
+    assert filters.top_k(keys, 3).tolist() == [1, 3, 2]
+    assert filters.top_k(keys, 4).tolist() == [1, 3, 2, 4]
+    assert filters.top_k(keys, 0).tolist() == []
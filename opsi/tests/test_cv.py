@@ -0,0 +1,266 @@
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+
+from opsi.manager.types import Range
+from opsi.modules.contour import ROI_TRACKERS, HookInstance, TrackROI, UpdateROI
+from opsi.util.cv import Contours, Mat, MatBW, Rect
+from opsi.util.cv.contour import _find_in_window
+from opsi.util.cv.shape import Circles, Segments
+
+from .util import noisy_contours, random_bgr
+
+
+def test_hsv_threshold_wraps_hue():
+    img = Mat(random_bgr())
+    sat, val = Range(20, 255), Range(10, 240)
+
+    wrapped = img.hsv_threshold(Range(170, 10), sat, val)
+    joined = MatBW.join(
+        img.hsv_threshold(Range(170, 179), sat, val),
+        img.hsv_threshold(Range(0, 10), sat, val),
+    )
+
+    assert np.array_equal(wrapped.img, joined.img)
+
+
+def test_hsv_threshold_wrap_keeps_source():
+    bgr = random_bgr()
+    original = bgr.copy()
+
+    mask = Mat(bgr).hsv_threshold(Range(151, 20), Range(0, 255), Range(0, 255))
+
+    assert np.array_equal(bgr, original)
+
+    hue = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)[..., 0]
+    expected = ((hue >= 151) | (hue <= 20)).astype(np.uint8) * 255
+    assert np.array_equal(mask.img, expected)
+
+
+def test_hsv_threshold_multi_matches_single():
+    img = Mat(random_bgr(1))
+    ranges = (
+        (Range(20, 40), Range(50, 255), Range(30, 220)),
+        (Range(160, 15), Range(0, 200), Range(60, 255)),
+        (Range(60.4, 90.6), Range(10, 250), Range(0, 255)),
+    )
+
+    masks = img.hsv_threshold_multi(ranges)
+
+    assert len(masks) == len(ranges)
+    for mask, (hue, sat, val) in zip(masks, ranges):
+        assert np.array_equal(mask.img, img.hsv_threshold(hue, sat, val).img)
+
+
+def test_roi_contours_use_full_frame_coordinates():
+    img = np.zeros((120, 160), dtype=np.uint8)
+    cv2.rectangle(img, (70, 40), (100, 60), 255, -1)
+    full = MatBW(img)
+    roi = full.roi(Rect.from_params(50, 30, 70, 50))
+
+    assert roi.img.base is img
+    assert roi.offset == (50, 30) and roi.full_res == full.res
+
+    # Per-pixel operations keep the region
+    eroded = roi.erode(1)
+    assert eroded.offset == roi.offset and eroded.full_res == roi.full_res
+    assert eroded.res == roi.res
+
+    full_contours = Contours.from_img(full)
+    roi_contours = Contours.from_img(roi)
+
+    assert roi_contours.res == full_contours.res
+    assert np.array_equal(roi_contours.raw[0], full_contours.raw[0])
+    assert roi_contours.l[0].centroid == full_contours.l[0].centroid
+
+    assert full.roi(Rect.from_params(200, 30, 10, 10)) is None  # Outside
+
+
+def test_track_roi():
+    img = np.zeros((120, 160), dtype=np.uint8)
+    cv2.rectangle(img, (70, 40), (100, 60), 255, -1)
+    frame = Mat(cv2.cvtColor(img, cv2.COLOR_GRAY2BGR))
+
+    track = TrackROI(TrackROI.Settings(name="test", padding_pct=0))
+    update = UpdateROI(UpdateROI.Settings(name="test"))
+    try:
+        assert track.run(TrackROI.Inputs(img=frame)).img is frame
+
+        contours = Contours.from_img(MatBW(img))
+        update.run(UpdateROI.Inputs(contours=contours))
+        out = track.run(TrackROI.Inputs(img=frame))
+        assert out.tracking and out.img.offset == (70, 40)
+
+        # A window outside of the frame finds nothing, rather than everything
+        track.window = Rect.from_params(200, 30, 10, 10)
+        with patch.object(HookInstance, "cancel_output") as cancel_output:
+            out = track.run(TrackROI.Inputs(img=frame))
+        cancel_output.assert_called_once_with("img")
+        assert out.img is None and not out.tracking
+        assert track.window is None
+    finally:
+        track.dispose()
+
+    assert "test" not in ROI_TRACKERS
+
+
+def test_pyramid_contours_match_full_resolution():
+    img = np.zeros((240, 320), dtype=np.uint8)
+    cv2.rectangle(img, (20, 30), (60, 90), 255, -1)
+    cv2.circle(img, (200, 120), 25, 255, -1)
+    cv2.rectangle(img, (230, 150), (300, 200), 255, -1)
+
+    full = Contours.from_img(MatBW(img))
+    coarse = Contours.from_img(MatBW(img), levels=2)
+
+    def key(raw):
+        return cv2.boundingRect(raw)
+
+    assert coarse.res == full.res
+    assert len(coarse.raw) == len(full.raw)
+    for a, b in zip(sorted(coarse.raw, key=key), sorted(full.raw, key=key)):
+        assert np.array_equal(a, b)
+
+
+def test_pyramid_contours_near_window_edge():
+    img = np.zeros((120, 160), dtype=np.uint8)
+    cv2.rectangle(img, (70, 40), (100, 60), 255, -1)
+    full = Contours.from_img(MatBW(img))
+
+    # The window cuts through the target, so it is grown to find all of it
+    window = Rect.from_params(50, 30, 30, 20)
+    raw = _find_in_window(MatBW(img), window, 2)
+    assert len(raw) == 1 and np.array_equal(raw[0], full.raw[0])
+
+    # A target at the edge of a region of interest, next to another one
+    cv2.rectangle(img, (104, 40), (120, 60), 255, -1)
+    roi = MatBW(img).roi(Rect.from_params(60, 30, 50, 40))
+    full = Contours.from_img(roi)
+    coarse = Contours.from_img(roi, levels=2)
+
+    def key(raw):
+        return cv2.boundingRect(raw)
+
+    assert len(coarse.raw) == len(full.raw) == 2
+    for a, b in zip(sorted(coarse.raw, key=key), sorted(full.raw, key=key)):
+        assert np.array_equal(a, b)
+
+
+def test_pyramid_contours_with_many_candidates():
+    img = (np.random.RandomState(0).rand(120, 160) > 0.995).astype(np.uint8) * 255
+    full = Contours.from_img(MatBW(img))
+    assert len(full.raw) > 32  # Searched in full, rather than in each window
+
+    coarse = Contours.from_img(MatBW(img), levels=1)
+    assert len(coarse.raw) == len(full.raw)
+
+
+def test_merge_overlapping():
+    random = np.random.RandomState(0)
+    rects = [
+        Rect.from_params(*random.randint(0, 200, 2), *random.randint(1, 20, 2))
+        for _ in range(200)
+    ]
+
+    merged = Rect.merge_overlapping(rects)
+
+    def contains(outer, inner):
+        return (
+            outer.tl.x <= inner.tl.x
+            and outer.tl.y <= inner.tl.y
+            and inner.br.x <= outer.br.x
+            and inner.br.y <= outer.br.y
+        )
+
+    # No two merged rects intersect, and each rect is inside exactly one
+    for i, rect in enumerate(merged):
+        assert not any(rect.intersects(other) for other in merged[i + 1 :])
+    for rect in rects:
+        assert sum(contains(other, rect) for other in merged) == 1
+
+
+def test_contour_batch_matches_contours():
+    contours = noisy_contours()
+    batch = contours.batch
+
+    assert len(batch) == len(contours.l) > 10
+    for i, contour in enumerate(contours.l):
+        assert np.array_equal(batch.raw(i), contour.raw)
+        assert np.isclose(batch.areas[i], contour.area)
+        assert np.allclose(batch.centroids[i], contour.centroid)
+        assert tuple(batch.bounding_rects[i]) == cv2.boundingRect(contour.raw)
+        assert np.isclose(
+            batch.vertical_angles[i], contour.to_min_area_rect.vertical_angle
+        )
+
+
+def _reference_corners(contour):
+    # The point-by-point implementation Contour.corners used to have
+    centroid = contour.pixel_centroid
+    points = [tuple(point) for point in contour.raw.reshape(-1, 2).tolist()]
+
+    def farthest(in_quadrant):
+        candidates = [
+            p for p in points if in_quadrant(p[0] - centroid.x, p[1] - centroid.y)
+        ]
+        if not candidates:
+            return None
+        return max(
+            candidates,
+            key=lambda p: (p[0] - centroid.x) ** 2 + (p[1] - centroid.y) ** 2,
+        )
+
+    corners = (
+        farthest(lambda x, y: x < 0 and y < 0),
+        farthest(lambda x, y: x > 0 and y < 0),
+        farthest(lambda x, y: x < 0 and y > 0),
+        farthest(lambda x, y: x > 0 and y > 0),
+    )
+    if len(points) < 4 or None in corners:
+        return False, None
+    return True, corners
+
+
+def test_corners_match_reference():
+    contours = noisy_contours()
+    found, corners = contours.batch.corners
+
+    assert found.any()
+    for i, contour in enumerate(contours.l):
+        ret, expected = _reference_corners(contour)
+        single_ret, single = contour.corners
+
+        assert single_ret == ret == found[i]
+        if ret:
+            assert tuple(single) == expected
+            assert tuple(map(tuple, corners[i].tolist())) == expected
+
+
+def test_nt_serialize_columns_and_limit():
+    circles = np.array([[[1, 2, 3], [4.5, 5, 6]]], dtype=np.float32).view(Circles)
+    segments = np.array([[[1, 2, 3, 4]], [[5, 6, 7, 8]]], dtype=np.int32)
+    segments = segments.view(Segments)
+
+    assert circles.nt_serialize() == {"x": [1, 4.5], "y": [2, 5], "radius": [3, 6]}
+    assert segments.nt_serialize(limit=1) == {
+        "x1": [1],
+        "y1": [2],
+        "x2": [3],
+        "y2": [4],
+    }
+    assert all(type(x) is float for x in segments.nt_serialize()["x1"])
+
+    contours = noisy_contours()
+    full = contours.nt_serialize()
+    limited = contours.nt_serialize(limit=5)
+
+    assert full["num_contours"] == len(contours.l)
+    assert limited["num_contours"] == 5
+    assert limited["x"] == full["x"][:5] and limited["area"] == full["area"][:5]
+
+    contour = contours.l[0]
+    points = contour.nt_serialize()
+    assert points["x"] == contour.raw[:, 0, 0].tolist()
+    assert points["num_points"] == len(contour.raw)
+    assert contour.nt_serialize(limit=1)["num_points"] == 1
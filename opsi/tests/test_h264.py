@@ -0,0 +1,88 @@
+from unittest.mock import patch
+
+import numpy as np
+
+from opsi.modules.videoio import h264
+from opsi.modules.videoio.h264 import H264CameraServer, detect_encoder
+from opsi.util.cv import Mat
+
+from .util import random_bgr
+
+
+def test_detect_encoder_cached():
+    detect_encoder.cache_clear()
+    with patch("subprocess.run") as run:
+        run.return_value.returncode = 0
+        assert detect_encoder() == "OpenMAX"
+        assert H264CameraServer("camera", 30).encoder == "OpenMAX"
+    detect_encoder.cache_clear()
+
+    assert run.call_count == 1
+
+
+def test_frame_for():
+    img = random_bgr()
+    server = H264CameraServer("camera", 30)
+    server.size = (img.shape[1], img.shape[0], 30)
+
+    assert server.frame_for(img) is img  # Already what the engine takes
+    assert server.ring is None
+
+    roi = server.frame_for(random_bgr(shape=(96, 64, 3))[::2])
+    grey = server.frame_for(img[..., 0])
+    small = server.frame_for(img[::2, ::2])
+    for frame in (roi, grey, small):
+        assert frame.shape == img.shape and frame.flags.c_contiguous
+
+    # Each in its own buffer, as the engine may still hold the last one
+    assert len({id(frame) for frame in (roi, grey, small)}) == 3
+    assert (grey[..., 2] == img[..., 0]).all()
+    assert server.frame_for(img[:, ::-1]) is roi  # Around the ring
+    assert np.array_equal(roi, img[:, ::-1])
+
+
+class FakeInputs:
+    def __init__(self, img):
+        self.img = Mat(img)
+
+
+def test_engine_restarts_only_on_change():
+    with patch.object(h264, "engine", create=True) as engine, patch.object(
+        h264, "NT_AVAIL", False
+    ), patch.object(h264, "detect_encoder", return_value="Software"):
+        manager = h264.EngineManager(hook=None)
+        img = random_bgr()
+
+        def server(name):
+            server = H264CameraServer(name, 30)
+            server.run(FakeInputs(img))  # Sets up its writer
+            server.register(manager)
+            return server
+
+        first = server("first")
+        manager.restart_engine()
+        assert engine.Engine.call_count == 1
+
+        manager.restart_engine()  # Nothing changed
+        assert engine.Engine.call_count == 1
+
+        second = server("second")
+        manager.restart_engine()
+        assert engine.Engine.call_count == 2
+
+        # A new size registers again, restarting straight away
+        first.run(FakeInputs(img[::2, ::2]))
+        first.register(manager)
+        assert engine.Engine.call_count == 3
+        manager.restart_engine()
+        assert engine.Engine.call_count == 3
+
+        # Replaced with an identical server, which has a new writer
+        second.unregister(manager)
+        server("second")
+        manager.restart_engine()
+        assert engine.Engine.call_count == 4
+
+        manager.shutdown()
+        manager.restart_engine()
+        assert engine.Engine.call_count == 5
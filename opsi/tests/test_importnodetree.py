@@ -22,3 +22,21 @@ def test_invalid_function_type_causes_error():
     assert error.node == node
 
     assert program.pipeline.broken
+
+
+def test_needs_restart():
+    from opsi.modules.videoio import CameraInput
+    from opsi.webserver.serialize import _needs_restart
+
+    settings = CameraInput.Settings(mode=0)
+    same = CameraInput.Settings(mode=0)
+    exposure = CameraInput.Settings(mode=0, exposure=10)
+    mode = CameraInput.Settings(mode=1)
+
+    assert not _needs_restart(True, settings, same)
+    assert _needs_restart(True, settings, exposure)
+    assert not _needs_restart(False, settings, exposure)
+
+    # Only the named settings
+    assert not _needs_restart(CameraInput.require_restart, settings, exposure)
+    assert _needs_restart(CameraInput.require_restart, settings, mode)
@@ -0,0 +1,219 @@
+import dataclasses
+import threading
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+import pytest
+
+from opsi.manager.manager_schema import BGR, GREY
+from opsi.modules.videoio import CameraInput, UndupeInstance
+from opsi.modules.videoio.input import (
+    CONTROLS,
+    MJPG_FOURCC,
+    YUYV_FOURCC,
+    FrameReader,
+    get_settings,
+    read_frame,
+    set_controls,
+)
+
+from .util import random_bgr
+
+
+def test_read_frame_scale():
+    img = random_bgr()
+    height, width = img.shape[:2]
+    raw = cv2.imencode(".jpg", img)[1].reshape(1, -1)  # As V4L reads it
+
+    for scale in (1, 2, 4, 8):
+        for frame, codec in ((raw, MJPG_FOURCC), (img, None)):
+            mat = read_frame(frame, scale, codec=codec)
+            assert mat.res == (width // scale, height // scale)
+
+    assert read_frame(raw, 1, codec=MJPG_FOURCC).jpg is not None
+    assert read_frame(raw, 2, codec=MJPG_FOURCC).jpg is None  # Not what is in the Mat
+
+    # The codec decides, not the shape
+    assert read_frame(img[:1, :, 0]).res == (width, 1)
+
+
+def test_read_frame_grey():
+    img = random_bgr()
+    raw = cv2.imencode(".jpg", img)[1].reshape(1, -1)
+    yuyv = np.dstack((img[..., 1], img[..., 0]))  # Luma, then chroma
+
+    for scale in (1, 2):
+        for frame, codec in ((raw, MJPG_FOURCC), (img, None), (yuyv, YUYV_FOURCC)):
+            mat = read_frame(frame, scale, GREY, codec)
+            assert mat.img.ndim == 2
+            assert mat.res == (img.shape[1] // scale, img.shape[0] // scale)
+            assert mat.jpg is None  # The jpg has colour
+
+    assert (read_frame(yuyv, 1, GREY, YUYV_FOURCC).img == img[..., 1]).all()
+    assert read_frame(yuyv, codec=YUYV_FOURCC).img.shape == img.shape
+
+
+class FakeControls:
+    def __init__(self):
+        self.props = {}
+
+    def set(self, prop, value):
+        self.props[prop] = value
+        return True
+
+    def get(self, prop):
+        return self.props[prop]
+
+
+def test_set_controls():
+    cap = FakeControls()
+    settings = get_settings()(mode=0)
+    set_controls(cap, settings)
+    assert cap.props == {prop: 50 for prop in CONTROLS.values()}
+
+    # Only what changed
+    cap.props.clear()
+    changed = dataclasses.replace(settings, exposure=10, scale="1/2")
+    assert set_controls(cap, changed, settings) >= 0
+    assert cap.props == {CONTROLS["exposure"]: 10}
+
+
+class FakeCapture:
+    def __init__(self, frames):
+        self.frames = iter(frames)
+        self.lock = threading.Semaphore(0)  # Released to let a frame through
+
+    def read(self):
+        self.lock.acquire()
+        frame = next(self.frames, None)
+        return frame is not None, frame
+
+
+def test_frame_reader():
+    img = random_bgr()
+    cap = FakeCapture([img, img[:10], img[:20]])
+    reader = FrameReader(cap)
+    reader.TIMEOUT = 0.1
+
+    try:
+        cap.lock.release()
+        assert reader.read().res.y == img.shape[0]
+
+        # Only the latest frame is kept
+        cap.lock.release()
+        cap.lock.release()
+        with reader._condition:
+            reader._condition.wait_for(lambda: reader._sequence == 3, 1)
+        assert reader.read().res.y == 20
+
+        with pytest.raises(ValueError, match="Timed out"):
+            reader.read()
+
+        cap.lock.release()  # Out of frames
+        with pytest.raises(ValueError, match="Unable to read"):
+            reader.read()
+    finally:
+        reader._running = False
+        cap.lock.release()
+        reader.stop()
+
+
+class ControlledCapture(FakeControls, FakeCapture):
+    def __init__(self, frames):
+        FakeControls.__init__(self)
+        FakeCapture.__init__(self, frames)
+        self.threads = set()  # Which set controls
+
+    def set(self, prop, value):
+        self.threads.add(threading.current_thread().name)
+        return super().set(prop, value)
+
+
+def test_frame_reader_controls():
+    img = random_bgr()
+    cap = ControlledCapture([img, img])
+    reader = FrameReader(cap)
+    settings = get_settings()(mode=0)
+
+    try:
+        cap.lock.release()
+        reader.read()
+
+        # Queued while the reader waits on the camera, and set between reads
+        reader.set_controls(dataclasses.replace(settings, exposure=10), settings)
+        reader.set_controls(dataclasses.replace(settings, contrast=20), settings)
+        cap.lock.release()
+        reader.read()
+        cap.lock.release()  # Out of frames, but set before trying
+        with pytest.raises(ValueError, match="Unable to read"):
+            reader.read()
+        assert cap.props == {CONTROLS["contrast"]: 20}
+        assert cap.threads == {"Camera reader"}
+    finally:
+        reader._running = False
+        cap.lock.release()
+        reader.stop()
+
+
+class ReleasedCapture:
+    def __init__(self):
+        self.released = False
+        self.reading = threading.Event()
+
+    def read(self):
+        assert not self.released, "Read after release"
+        self.reading.set()
+        return True, random_bgr()
+
+    def release(self):
+        # Nothing may still read it, or claim the camera for a new capture
+        assert 0 in UndupeInstance.keys
+        self.released = True
+
+
+def test_camera_input_dispose():
+    cap = ReleasedCapture()
+    with patch("opsi.modules.videoio.create_capture", return_value=(cap, None)):
+        func = CameraInput(get_settings()(mode=0))
+    assert cap.reading.wait(1)
+
+    func.dispose()
+    assert cap.released
+    assert not func.reader._thread.is_alive()
+    assert 0 not in UndupeInstance.keys
+
+    # Failing to claim the camera leaves the other CameraInput's claim
+    UndupeInstance.add(0)
+    with pytest.raises(ValueError, match="already in use"):
+        CameraInput(get_settings()(mode=0))
+    assert 0 in UndupeInstance.keys
+    UndupeInstance.remove(0)
+
+
+def test_camera_input_format_change():
+    img = random_bgr()
+    cap = ControlledCapture([img] * 4)
+    cap.release = lambda: None
+    cap.lock.release()  # For the test read in on_start
+    with patch("opsi.modules.videoio.create_capture", return_value=(cap, None)):
+        func = CameraInput(get_settings()(mode=0))
+    reader = func.reader
+
+    def decoded(format):
+        # A frame decoded in this format, then the other negotiated
+        reader.format = format
+        sequence = reader._sequence
+        cap.lock.release()
+        with reader._condition:
+            reader._condition.wait_for(lambda: reader._sequence > sequence, 1)
+        func.negotiate_formats({"img": {BGR} if format == GREY else {GREY}})
+        return func.run(None).img
+
+    try:
+        assert decoded(BGR).img.ndim == 2
+        assert decoded(GREY).img.shape == img.shape
+    finally:
+        reader._running = False
+        cap.lock.release()
+        func.dispose()
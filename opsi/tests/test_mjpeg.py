@@ -0,0 +1,381 @@
+import asyncio
+import json
+import threading
+
+import cv2
+from starlette.requests import Request
+
+from opsi.modules.videoio.camhook import CamHook
+from opsi.modules.videoio.input import MJPG_FOURCC, read_frame
+from opsi.modules.videoio.mjpeg import (
+    AdaptiveRate,
+    BandwidthAllocator,
+    ClientStats,
+    MjpegCameraServer,
+    Params,
+    jpeg_response,
+    share_bandwidth,
+)
+from opsi.modules.videoio.websocket import FRAME_HEADER, websocket_stream
+from opsi.util.cv import Mat, Point
+
+from .util import random_bgr
+
+
+class Inputs:
+    def __init__(self, img):
+        self.img = img
+
+
+class CountingMat(Mat):
+    encodes = 0
+
+    def encode_jpg(self, quality=80):
+        CountingMat.encodes += 1
+        return super().encode_jpg(quality)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_sink_shares_encodes():
+    camserv = MjpegCameraServer()
+    sink = camserv.src
+    CountingMat.encodes = 0
+
+    async def clients():
+        sink.frame = CountingMat(random_bgr())
+
+        # Asked for together, encoded once
+        first, second = await asyncio.gather(
+            sink.get_jpg(None, 70), sink.get_jpg(None, 70)
+        )
+        assert first == second
+        assert await sink.get_jpg(None, 70) == first
+        assert CountingMat.encodes == 1
+
+        await sink.get_jpg(None, 50)
+        assert CountingMat.encodes == 2
+
+        sink.frame = CountingMat(random_bgr())
+        jpg = await sink.get_jpg(None, 70)
+        assert jpg.sequence == first.sequence + 1
+        assert jpg.timestamp >= first.timestamp
+        assert CountingMat.encodes == 3
+
+    try:
+        run(clients())
+    finally:
+        camserv.dispose()
+
+    assert len(sink.samples()) == 3
+
+
+def test_sink_ended_get_jpg():
+    camserv = MjpegCameraServer()
+    sink = camserv.src
+    sink.frame = Mat(random_bgr())
+
+    # Disposed on the pipeline thread between a stream's wait_frame and get_jpg
+    sink._executor.shutdown()
+    assert run(sink.get_jpg(None, 70)) is None
+
+    camserv.dispose()
+    assert run(sink.get_jpg(None, 70)) is None
+
+
+def test_snapshot():
+    class Func:  # What CamHook passes to the endpoint
+        src = MjpegCameraServer()
+
+    def request(query):
+        scope = {"type": "http", "query_string": query, "headers": []}
+        return Request(scope)
+
+    sink = Func.src.src
+
+    async def snapshots():
+        response = await jpeg_response(request(b""), Func)
+        assert response.status_code == 503
+
+        sink.frame = Mat(random_bgr())
+        response = await jpeg_response(request(b"resolution=32x24"), Func)
+        assert response.status_code == 200
+        assert response.media_type == "image/jpeg"
+        assert response.body[:2] == b"\xff\xd8"
+
+        jpg = await sink.get_jpg(Point(32, 24), 70)
+        assert jpg.data == response.body
+
+    try:
+        run(snapshots())
+    finally:
+        Func.src.dispose()
+
+
+def test_wait_frame():
+    camserv = MjpegCameraServer()
+    sink = camserv.src
+    img = Mat(random_bgr())
+
+    async def waits():
+        loop = asyncio.get_running_loop()
+
+        # Woken by the pipeline thread
+        def run_pipeline():
+            threading.Thread(target=camserv.run, args=(Inputs(img),)).start()
+
+        loop.call_later(0.02, run_pipeline)
+        assert await asyncio.wait_for(sink.wait_frame(0), 1) == 1
+
+        # Returns right away if there is a newer frame already
+        assert await sink.wait_frame(0) == 1
+
+        # Woken by stop, after wake()
+        stopped = False
+
+        def stop():
+            nonlocal stopped
+            stopped = True
+            sink.wake()
+
+        loop.call_later(0.02, stop)
+        assert await asyncio.wait_for(sink.wait_frame(1, lambda: stopped), 1) == 0
+
+        # Woken by the sink ending
+        def dispose():
+            threading.Thread(target=camserv.dispose).start()
+
+        loop.call_later(0.02, dispose)
+        assert await asyncio.wait_for(sink.wait_frame(1), 1) == 0
+
+    run(waits())
+
+
+def test_adaptive_rate():
+    rate = AdaptiveRate(quality=70, fps=30)
+
+    # Sends which wait for the client lower quality, then the frame rate
+    now = 0
+    qualities = []
+    for _ in range(8):
+        now += rate.interval
+        assert rate.update(now, waited=rate.interval, size=1000)
+        qualities.append(rate.quality)
+    assert qualities[:6] == [60, 50, 40, 30, 20, 20]
+    assert rate.fps < 30
+
+    # Recovers the frame rate, then quality
+    assert not rate.update(now, waited=0, size=1000)
+    while rate.fps < 30:
+        now += AdaptiveRate.RECOVER_AFTER
+        rate.update(now, waited=0, size=1000)
+        assert rate.quality == 20
+    while rate.quality < 70:
+        now += AdaptiveRate.RECOVER_AFTER
+        rate.update(now, waited=0, size=1000)
+    assert (rate.quality, rate.fps) == (70, 30)
+
+
+def test_client_stats():
+    stats = ClientStats("127.0.0.1:5800", AdaptiveRate(70, 30))
+
+    for i in range(21):
+        stats.sent(i * 0.1, 1000, drops=i % 2)
+
+    assert stats.frames == 21
+    assert stats.bytes == 21000
+    assert stats.drops == 10
+    assert abs(stats.fps - 10) < 1e-6
+    assert abs(stats.bytes_per_second - 10000) < 1e-3
+    assert stats.as_dict()["quality"] == 70
+
+
+def test_adaptive_rate_budget():
+    rate = AdaptiveRate(quality=70, fps=30)
+    rate.budget = 50_000
+
+    def size():  # Of a jpg, roughly
+        return 200_000 * rate.quality / 100 / rate.scale ** 2
+
+    # Lowers quality, then resolution, to afford BUDGET_FPS
+    now = 0
+    for _ in range(20):
+        rate.update(now, waited=0, size=size())
+        now += rate.interval
+    assert rate.scale == 4
+    assert rate.quality < 70
+    assert rate.budget_fps >= AdaptiveRate.BUDGET_FPS
+    assert rate.interval == 1 / rate.budget_fps
+
+    # And back up, when the budget grows
+    rate.budget = 10_000_000
+    for _ in range(20):
+        now += AdaptiveRate.RECOVER_AFTER
+        rate.update(now, waited=0, size=size())
+    assert (rate.quality, rate.scale) == (70, 1)
+    assert rate.resolution(None, Point(640, 480)) is None
+
+    rate.scale = 2
+    assert rate.resolution(None, Point(640, 480)) == (320, 240)
+
+
+def test_share_bandwidth():
+    assert share_bandwidth(90, {"a": 10, "b": 100, "c": float("inf")}) == {
+        "a": 10,
+        "b": 40,
+        "c": 40,
+    }
+    assert share_bandwidth(90, {"a": 10, "b": 20}) == {"a": 10, "b": 20}
+
+
+def test_bandwidth_allocator():
+    budget = 0
+    allocator = BandwidthAllocator(lambda: budget)
+
+    small = ClientStats("small", AdaptiveRate(70, 10))
+    small.rate.frame_bytes = 1000  # Unconstrained, needs 10kB/s
+    big = ClientStats("big", AdaptiveRate(70, 30))  # Nothing sent yet
+    allocator.add(small)
+    allocator.add(big)
+
+    allocator.update(0)
+    assert small.rate.budget == big.rate.budget == 0
+
+    budget = 100_000
+    allocator.update(0.5)  # Not yet
+    assert big.rate.budget == 0
+    allocator.update(1)
+    assert small.rate.budget == 1000 * 10 * BandwidthAllocator.HEADROOM
+    assert big.rate.budget == budget - small.rate.budget
+
+    allocator.remove(small)
+    allocator.update(1.1)  # Right away when clients change
+    assert big.rate.budget == budget
+    assert allocator.as_dict()["allocated"] == budget
+
+
+class FakeWebSocket:
+    def __init__(self, query):
+        self.query_params = query
+        self.client = ("127.0.0.1", 5800)
+        self.messages = asyncio.Queue()
+        self.sent = asyncio.Queue()
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def receive(self):
+        return await self.messages.get()
+
+    async def send_bytes(self, data):
+        await self.sent.put(data)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_websocket_stream():
+    class Func:
+        id = "camera"
+        src = MjpegCameraServer()
+
+    allocator = BandwidthAllocator(lambda: 0)
+
+    async def client():
+        websocket = FakeWebSocket({"resolution": "32x24"})
+        task = asyncio.ensure_future(websocket_stream(websocket, Func, allocator))
+
+        Func.src.src.frame = Mat(random_bgr())
+        message = await asyncio.wait_for(websocket.sent.get(), 1)
+        sequence, drops, timestamp, sent, length = FRAME_HEADER.unpack_from(message)
+        assert (sequence, drops) == (1, 0)
+        assert timestamp <= sent
+        start = FRAME_HEADER.size
+        assert message[start : start + length] == b"camera"
+        jpg = await Func.src.src.get_jpg(Point(32, 24), 70)
+        assert message[start + length :] == jpg.data
+
+        # Parameters can change while streaming, and bad ones are ignored
+        await websocket.messages.put({"type": "websocket.receive", "text": "[]"})
+        await websocket.messages.put(
+            {"type": "websocket.receive", "text": '{"fps": 5, "compression": 50}'}
+        )
+        await asyncio.sleep(0.01)
+        (stream,) = allocator.clients
+        assert (stream.rate.max_fps, stream.rate.max_quality) == (5, 50)
+
+        await websocket.messages.put({"type": "websocket.disconnect"})
+        await asyncio.wait_for(task, 1)
+        assert not websocket.closed
+        assert not allocator.clients
+
+        # Closed when the CameraServer goes away
+        websocket = FakeWebSocket({})
+        task = asyncio.ensure_future(websocket_stream(websocket, Func, allocator))
+        await asyncio.wait_for(websocket.sent.get(), 1)
+        Func.src.dispose()
+        await asyncio.wait_for(task, 1)
+        assert websocket.closed
+
+    run(client())
+
+
+def test_hook_stats():
+    class Func:
+        id = "stats_camera"
+        src = MjpegCameraServer()
+
+    hook = CamHook()
+    hook.register(Func)
+    try:
+        Func.src.src.frame = Mat(random_bgr())
+        run(Func.src.src.get_jpg(None, 70))
+
+        response = hook.stats_endpoint(None)
+        stats = json.loads(response.body)
+        assert stats["clients"] == {"stats_camera": []}
+        assert stats["bandwidth"]["measured"] == 0
+        assert stats["encode"]["stats_camera"]["max"] > 0
+        assert stats["write"] == {}
+        assert CamHook.STATS_URL in {route.path for route in hook.app.routes}
+    finally:
+        hook.unregister(Func)
+        Func.src.dispose()
+
+
+def test_pass_through():
+    raw = cv2.imencode(".jpg", random_bgr())[1].reshape(1, -1)  # As V4L reads it
+    frame = read_frame(raw, codec=MJPG_FOURCC)
+    assert frame.jpg == raw.tobytes()
+    assert frame.img.shape == random_bgr().shape
+    assert read_frame(random_bgr()).jpg is None
+    assert frame.resize(Point(32, 24)).jpg is None
+
+    assert Params.create({}).as_sent
+    assert not Params.create({"compression": "30"}).as_sent
+    assert not Params.create({"resolution": "32x24"}).as_sent
+
+    camserv = MjpegCameraServer()
+    sink = camserv.src
+    CountingMat.encodes = 0
+
+    async def get():
+        sink.frame = CountingMat.from_jpg(raw)
+        assert (await sink.get_jpg(None, None)).data == raw.tobytes()
+        assert CountingMat.encodes == 0
+
+        sink.frame = CountingMat(random_bgr())
+        jpg = await sink.get_jpg(None, None)  # Not from a jpg, so the default
+        assert jpg.data == sink.frame.encode_jpg(Params().quality)
+
+    try:
+        run(get())
+    finally:
+        camserv.dispose()
@@ -0,0 +1,202 @@
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from opsi.manager.netdict import NT_AVAIL, NT_PUBLISHER, NetworkDict
+
+pytestmark = pytest.mark.skipif(not NT_AVAIL, reason="pynetworktables not installed")
+
+
+@pytest.fixture
+def netdict():
+    from networktables import NetworkTablesInstance
+
+    return NetworkDict("/test", NetworkTablesInstance.create())
+
+
+def written(netdict, name):
+    return netdict.api.storage.m_entries[netdict._get_path(name)].value
+
+
+def test_publish_writes_values(netdict):
+    netdict.publish({"a": 1, "b": [1.0, 2.5], "c": "text", "d": True})
+
+    assert netdict["a"] == 1
+    assert netdict["b"] == (1.0, 2.5)
+    assert netdict["c"] == "text"
+    assert netdict["d"] is True
+
+
+def test_publish_skips_unchanged(netdict):
+    netdict.publish({"a": [1, 2], "b": 3})
+    value = written(netdict, "a")
+
+    netdict.publish({"a": [1, 2], "b": 4})
+
+    assert written(netdict, "a") is value
+    assert netdict["b"] == 4
+
+
+def test_publish_rewrites_after_other_writers(netdict):
+    netdict.publish({"a": 1.0})
+    netdict["a"] = 2.0
+    netdict.publish({"a": 1.0})
+    assert netdict["a"] == 1.0
+
+    netdict.delete("a")
+    netdict.publish({"a": 1.0})
+    assert netdict["a"] == 1.0
+
+
+def test_publish_type_changes(netdict):
+    netdict.publish({"a": 1})
+    netdict.publish({"a": True})
+    assert netdict["a"] is True
+
+    netdict.publish({"b": [1.0]})
+    netdict.publish({"b": []})  # reuses the array type written before
+    assert netdict["b"] == ()
+
+    with pytest.raises(TypeError):
+        netdict.publish({"c": []})
+
+    with pytest.raises(TypeError):
+        netdict.publish({"d": object()})
+
+
+@pytest.mark.parametrize("bad", (np.int64(3), [None], [1, "a"]))
+def test_publish_writes_around_bad_values(netdict, bad):
+    netdict.publish({"bad": 1.0})  # Left as it was
+
+    with pytest.raises(TypeError, match="'bad'"):
+        netdict.publish({"bad": bad, "good": 2.0})
+
+    assert netdict["good"] == 2.0
+    assert netdict["bad"] == 1.0
+
+
+@pytest.mark.parametrize("failure", ("missing", "broken"))
+def test_publish_without_batch_api(netdict, failure):
+    if failure == "missing":
+        patcher = patch("opsi.manager.netdict._has_batch_api", return_value=False)
+    else:  # Fails like a changed signature would, once
+        storage = netdict.api.storage
+        original = storage._setEntryValueImpl
+        calls = []
+
+        def set_entry_value(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise TypeError("unexpected argument")
+            return original(*args)
+
+        patcher = patch.object(storage, "_setEntryValueImpl", set_entry_value)
+
+    try:
+        with patcher:
+            netdict.publish({"a": 1, "b": [1.0, 2.5]})
+            netdict.publish({"a": True, "b": [1.0, 2.5]})
+
+        assert NetworkDict._batch_failed == (failure == "broken")
+    finally:
+        NetworkDict._batch_failed = False
+
+    assert netdict["a"] is True
+    assert netdict["b"] == (1.0, 2.5)
+
+
+def test_put_nt_writes_without_peers():
+    from opsi.modules.nt.put import PutNT
+
+    put = PutNT(PutNT.Settings(path="/test_put", key="value"))
+    try:
+        assert not put.table.networktable.isConnected()
+        put.run(PutNT.Inputs(val=1.5))
+        NT_PUBLISHER.end_frame()
+
+        for _ in range(100):
+            if put.table.get("value", None) == 1.5:
+                break
+            time.sleep(0.01)
+    finally:
+        put.dispose()
+
+    assert put.table["value"] == 1.5
+
+
+class Serialized:
+    def __init__(self, values):
+        self.values = values
+
+    def nt_serialize(self):
+        return self.values
+
+
+@pytest.mark.parametrize(
+    "val", (np.int64(3), [None], [{}], object(), Serialized({"x": 1.0, "y": [None]}))
+)
+def test_put_nt_rejects_bad_values(val):
+    from opsi.modules.nt.put import PutNT
+
+    put = PutNT(PutNT.Settings(path="/test_put", key="value"))
+    try:
+        with pytest.raises(TypeError, match="cannot be written to NT"):
+            put.run(PutNT.Inputs(val=val))
+        assert not NT_PUBLISHER._frame  # Nothing submitted
+    finally:
+        put.dispose()
+
+
+def test_publisher_coalesces_frames(netdict):
+    from opsi.manager.netdict import NTPublisher
+
+    publisher = NTPublisher(max_rate=0)
+    try:
+        # Hold the storage lock so the publisher cannot finish the first frame
+        with netdict.api.storage.m_mutex:
+            for i in range(5):
+                publisher.submit(netdict, {"a": float(i), f"only{i}": True})
+                publisher.end_frame()
+
+        for _ in range(100):
+            if netdict.get("a", None) == 4.0:
+                break
+            time.sleep(0.01)
+    finally:
+        publisher.stop()
+
+    assert netdict["a"] == 4.0
+    assert all(netdict[f"only{i}"] for i in range(5))
+    assert publisher.coalesced >= 3
+
+    latencies, publish_times = publisher.samples()
+    assert 1 <= len(latencies) <= 2 and len(publish_times) == len(latencies)
+
+
+def test_listener_follows_changes(netdict):
+    values = []
+
+    netdict["a"] = 1.0
+    listener = netdict.add_listener("a", values.append)
+
+    netdict["a"] = 2.0
+    netdict["a"] = 2.0  # unchanged, no notification
+    netdict.delete("a")
+    netdict["b"] = 3.0  # other keys are not listened to
+    netdict.api.waitForEntryListenerQueue(1)
+
+    netdict.remove_listener(listener)
+    netdict["a"] = 4.0
+    netdict.api.waitForEntryListenerQueue(1)
+
+    assert values == [1.0, 2.0, None]
+
+
+def test_get_nt_has_no_write_settings():
+    from opsi.modules.nt.get import GetNT
+    from opsi.modules.nt.put import PutNT
+
+    assert "max_items" in {field.name for field in PutNT.SettingTypes}
+    assert "max_items" not in {field.name for field in GetNT.SettingTypes}
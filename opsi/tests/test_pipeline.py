@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+
+from opsi.manager.manager_schema import BGR, GREY, Function
+from opsi.manager.pipeline import Connection
+from opsi.modules.color import Greyscale
+from opsi.util.cv import Mat
+
+from .util import mock_fifolock  # noqa
+from .util import create_program, random_bgr
+
+
+class Source(Function):
+    @dataclass
+    class Outputs:
+        img: Mat
+
+    def on_start(self):
+        self.formats = None
+
+    def negotiate_formats(self, formats):
+        self.formats = formats
+
+    def run(self, inputs):
+        img = random_bgr()
+        if self.formats == {"img": {GREY}}:
+            img = img[..., 0]
+        return self.Outputs(img=Mat(img))
+
+
+class Colour(Function):
+    @dataclass
+    class Inputs:
+        img: Mat
+
+    @dataclass
+    class Outputs:
+        channels: int
+
+    def run(self, inputs):
+        return self.Outputs(channels=inputs.img.img.ndim)
+
+
+def create_node(pipeline, func, id):
+    node = pipeline.create_node(func, id)
+    node.settings = func.Settings()
+    return node
+
+
+def test_negotiate_formats():
+    pipeline = create_program().pipeline
+
+    source = create_node(pipeline, Source, "source")
+    grey = create_node(pipeline, Greyscale, "grey")
+    pipeline.create_links("grey", {"img": Connection("source", "img")})
+
+    pipeline.run()
+    assert source.func.formats == {"img": {GREY}}
+    assert grey.results.img.img.ndim == 2
+
+    # Another consumer needing colour
+    colour = create_node(pipeline, Colour, "colour")
+    pipeline.create_links("colour", {"img": Connection("source", "img")})
+
+    pipeline.run()
+    assert source.func.formats == {"img": {BGR, GREY}}
+    assert colour.results.channels == 3
+    assert grey.results.img.img.ndim == 2
+
+    # Restarted functions are told again
+    source.dispose()
+    pipeline.run()
+    assert source.func.formats == {"img": {BGR, GREY}}
@@ -0,0 +1,96 @@
+import threading
+import uuid
+
+import pytest
+
+from opsi.util.cv import Point
+from opsi.util.packet import HEADER, KIND_NONE, KIND_POINT
+from opsi.util.shm import (
+    SEGMENT_HEADER,
+    SharedMemoryReader,
+    SharedMemoryWriter,
+    segment_path,
+)
+
+
+@pytest.fixture
+def name():
+    name = f"test-{uuid.uuid4().hex}"
+    yield name
+    segment_path(name).unlink()
+
+
+def test_reader_gets_latest(name):
+    writer = SharedMemoryWriter(name, channel=3)
+
+    with SharedMemoryReader(name) as reader:
+        assert reader.read() is None
+
+        writer.write(Point(1, 2))
+        writer.write(Point(3, 4))
+        packet = reader.read()
+
+        assert packet.kind == KIND_POINT
+        assert packet.values == (3.0, 4.0)
+        assert packet.channel == 3 and packet.sequence == 1
+
+        writer.write(None)
+        assert reader.read().kind == KIND_NONE
+
+    writer.close()
+
+
+def test_new_writer_continues_lock(name):
+    writer = SharedMemoryWriter(name)
+    writer.write(1)
+    lock = writer.lock
+    writer.close()
+
+    writer = SharedMemoryWriter(name)
+    assert writer.lock == lock
+    writer.close()
+
+
+def test_torn_packet_rejected(name):
+    writer = SharedMemoryWriter(name)
+    writer.write(Point(1, 2))
+
+    with SharedMemoryReader(name) as reader:
+        assert reader.read().values == (1.0, 2.0)
+
+        # Part of the next packet, seen with the lock already even again
+        writer.map[SEGMENT_HEADER.size + HEADER.size] ^= 0xFF
+        assert reader.read(retries=3) is None
+
+        writer.write(Point(3, 4))
+        assert reader.read().values == (3.0, 4.0)
+
+    writer.close()
+
+
+def test_reads_are_consistent(name):
+    writer = SharedMemoryWriter(name)
+    writer.write(Point(0, 0))
+    done = threading.Event()
+
+    def write():
+        i = 0
+        while not done.is_set():
+            i += 1
+            writer.write(Point(i, -i))
+
+    thread = threading.Thread(target=write)
+    thread.start()
+
+    with SharedMemoryReader(name) as reader:
+        try:
+            for _ in range(2000):
+                packet = reader.read()
+                if packet is not None:
+                    x, y = packet.values
+                    assert x == -y
+        finally:
+            done.set()
+            thread.join()
+
+    writer.close()
@@ -0,0 +1,83 @@
+import socket
+import threading
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from opsi.util.cv import Point
+from opsi.util.cv.shape import Corners, Pose3D
+from opsi.util.packet import KIND_CORNERS, KIND_NONE, KIND_NUMBER, KIND_POINT, KIND_POSE
+from opsi.util.udp import UDPReceiver, UDPSender
+
+
+@pytest.fixture
+def loopback():
+    with UDPReceiver() as receiver:
+        sender = UDPSender(receiver.host, receiver.port, channel=7)
+        yield sender, receiver
+        sender.close()
+
+
+def test_values_round_trip(loopback):
+    sender, receiver = loopback
+    pose = Pose3D(rvec=np.array([[0.1], [0.2], [0.3]]), tvec=np.array([[1], [2], [3]]))
+    corners = Corners(Point(1, 2), Point(3, 4), Point(5, 6), Point(7, 8))
+
+    expected = [
+        (Point(1.5, -2), KIND_POINT, (1.5, -2.0)),
+        (3, KIND_NUMBER, (3.0,)),
+        (True, KIND_NUMBER, (1.0,)),
+        (pose, KIND_POSE, (0.1, 0.2, 0.3, 1.0, 2.0, 3.0)),
+        (corners, KIND_CORNERS, tuple(range(1, 9))),
+        (None, KIND_NONE, ()),
+    ]
+
+    for value, _, _ in expected:
+        sender.send(value)
+
+    for sequence, (_, kind, values) in enumerate(expected):
+        packet = receiver.receive()
+
+        assert packet.kind == kind
+        assert packet.values == values
+        assert packet.channel == 7
+        assert packet.sequence == sequence
+        assert 0 <= packet.latency < 1
+
+
+def test_unsupported_type(loopback):
+    sender, _ = loopback
+
+    with pytest.raises(TypeError):
+        sender.send("text")
+
+
+def test_host_resolved_in_background():
+    lookup = threading.Event()  # Set to let the lookup finish
+    getaddrinfo = socket.getaddrinfo
+
+    def slow_getaddrinfo(host, port, family, type, proto, flags):
+        if host == "robot.local":
+            if flags & socket.AI_NUMERICHOST:
+                raise socket.gaierror("Not a numeric address")
+            lookup.wait(1)
+            host = "127.0.0.1"
+        return getaddrinfo(host, port, family, type, proto, flags)
+
+    with UDPReceiver() as receiver, patch("socket.getaddrinfo", slow_getaddrinfo):
+        sender = UDPSender("robot.local", receiver.port)
+        try:
+            # Dropped rather than waiting for the lookup
+            start = time.monotonic()
+            sender.send(1)
+            assert time.monotonic() - start < 0.1
+            assert sender.address is None
+
+            lookup.set()
+            sender._resolver.join(1)
+            sender.send(2)
+            assert receiver.receive().values == (2.0,)
+        finally:
+            sender.close()
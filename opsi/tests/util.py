@@ -1,7 +1,11 @@
 from unittest.mock import MagicMock, patch
 
+import cv2
+import numpy as np
 import pytest
 
+from opsi.util.cv import Contours, MatBW
+
 
 def create_program():
     from opsi.lifespan.lifespan import Lifespan
@@ -19,3 +23,13 @@ def create_program():
 def mock_fifolock():
     with patch("opsi.util.concurrency.FifoLock", autospec=True, spec_set=True):
         yield
+
+
+def random_bgr(seed=0, shape=(48, 64, 3)):
+    return np.random.RandomState(seed).randint(0, 256, shape, dtype=np.uint8)
+
+
+def noisy_contours(seed=0, shape=(120, 160)):
+    noise = np.random.RandomState(seed).rand(*shape) > 0.7
+    img = cv2.medianBlur(noise.astype(np.uint8) * 255, 5)
+    return Contours.from_img(MatBW(img))
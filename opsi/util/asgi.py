@@ -1,4 +1,5 @@
 import asyncio
+from time import perf_counter
 
 # Reusable ASGI framework
 
@@ -140,5 +141,12 @@ class ASGIStreamer(ASGIApplication):
 
         super().__init__(receive, send, status=status, headers=headers)
 
-    async def send(self, data):
-        await super().send(self._boundary + data)
+    # The boundary and preamble are sent separately from data, so it is not
+    # copied just to join them. Returns seconds spent waiting, which is only
+    # more than 0 while the client is not keeping up and the server's write
+    # buffer is full
+    async def send(self, data, preamble=b"") -> float:
+        start = perf_counter()
+        await super().send(self._boundary + preamble)
+        await super().send(data)
+        return perf_counter() - start
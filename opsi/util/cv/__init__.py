@@ -1,3 +1,3 @@
-from .contour import Contour, Contours
+from .contour import Contour, ContourBatch, Contours
 from .mat import Mat, MatBW
 from .shape import Point, Rect
@@ -1,26 +1,25 @@
 from typing import List, Tuple, Union
 
 import cv2
+import numpy as np
 from numpy import ndarray
 
 from opsi.util.cache import cached_property
 
-from .mat import MatBW
-from .shape import Corners, Point, Rect, RotatedRect
+from .mat import MatBW, pyramid_margin, pyramid_windows
+from .shape import Corners, Point, Rect, RotatedRect, nt_columns
 
 
 class Contour:
-    def nt_serialize(self):
-        points_x = [point.x for point in self.points]
-        points_y = [point.y for point in self.points]
+    def nt_serialize(self, limit: int = None):  # limit: max points to publish
+        points = nt_columns(self.raw, ("x", "y"), limit)
 
         return {
-            "x": points_x,
-            "y": points_y,
+            **points,
             "centroid_x": self.centroid.x,
             "centroid_y": self.centroid.y,
             "area": self.area,
-            "num_points": len(self.points),
+            "num_points": len(points["x"]),
         }
 
     # https://docs.opencv.org/trunk/dd/d49/tutorial_py_contour_features.html
@@ -104,70 +103,259 @@ class Contour:
 
     @cached_property
     def corners(self) -> Tuple[bool, Union[Corners, None]]:
-        centroid = self.pixel_centroid
-        points = self.points
-        if len(points) < 4:
+        if len(self.raw) < 4:
             return False, None
 
-        def centerDistance(point: Point):
-            return (point.x - centroid.x) ** 2 + (point.y - centroid.y) ** 2
-
-        try:
-            tl = sorted(
-                [
-                    point
-                    for point in points
-                    if point.x < centroid.x and point.y < centroid.y
-                ],
-                key=centerDistance,
-                reverse=True,
-            )[0]
-            tr = sorted(
-                [
-                    point
-                    for point in points
-                    if point.x > centroid.x and point.y < centroid.y
-                ],
-                key=centerDistance,
-                reverse=True,
-            )[0]
-            bl = sorted(
-                [
-                    point
-                    for point in points
-                    if point.x < centroid.x and point.y > centroid.y
-                ],
-                key=centerDistance,
-                reverse=True,
-            )[0]
-            br = sorted(
-                [
-                    point
-                    for point in points
-                    if point.x > centroid.x and point.y > centroid.y
-                ],
-                key=centerDistance,
-                reverse=True,
-            )[0]
-        except IndexError:
+        found, corners = _find_corners(
+            self.raw.reshape(1, -1, 2), np.array([self.pixel_centroid])
+        )
+        if not found[0]:
             return False, None
 
-        return True, Corners(tl, tr, bl, br)
+        return True, Corners.from_array(corners[0])
+
+
+def _find_corners(points: ndarray, centroids: ndarray, groups: ndarray = None):
+    """
+    points: (M, 2) points, or (1, M, 2) when they all belong to one contour
+    centroids: (N, 2) pixel centroid of each contour
+    groups: (M,) index of the contour of each point, if there is more than one
+
+    Returns (found, corners), where found[i] is False if contour i is missing a
+    point in one of its quadrants, and corners[i] is (tl, tr, bl, br) of contour i.
+    The corner of each quadrant is its point farthest from the centroid,
+    choosing the first point when several are equally far
+    """
+
+    points = points.reshape(-1, 2)
+    if groups is None:
+        groups = np.zeros(len(points), dtype=np.intp)
+
+    offset = points - centroids[groups]
+    dist = (offset[:, 0] ** 2) + (offset[:, 1] ** 2)
+
+    # quadrant 0 - 3 is tl, tr, bl, br. Points on either axis belong to none
+    quadrant = (offset[:, 0] > 0) + 2 * (offset[:, 1] > 0)
+    on_axis = (offset[:, 0] == 0) | (offset[:, 1] == 0)
+
+    # Order points by quadrant of each contour, then farthest first, then original
+    # order, so the first point of each quadrant is its corner
+    bucket = np.where(on_axis, -1, groups * 4 + quadrant)
+    order = np.lexsort((np.arange(len(points)), -dist, bucket))
+    buckets, first = np.unique(bucket[order], return_index=True)
+
+    corners = np.zeros((len(centroids) * 4, 2), dtype=points.dtype)
+    found = np.zeros(len(centroids) * 4, dtype=bool)
+
+    valid = buckets >= 0
+    corners[buckets[valid]] = points[order[first[valid]]]
+    found[buckets[valid]] = True
+
+    return found.reshape(-1, 4).all(axis=1), corners.reshape(-1, 4, 2)
+
+
+def _clipped_by_window(contour_raw: ndarray, window: MatBW, img: MatBW) -> bool:
+    # True if the contour touches an edge of window that is not an edge of img,
+    # meaning it is only part of a contour that continues outside of window
+    x, y, w, h = cv2.boundingRect(contour_raw)
+
+    left, top = window.offset
+    right, bottom = left + window.res.x, top + window.res.y
+
+    return (
+        (left > img.offset.x and x <= left)
+        or (top > img.offset.y and y <= top)
+        or (right < img.offset.x + img.res.x and x + w >= right)
+        or (bottom < img.offset.y + img.res.y and y + h >= bottom)
+    )
+
+
+def _find_in_window(img: MatBW, window: Rect, margin: int) -> List[ndarray]:
+    # Contours of img inside window. Any touching an edge of the window continue
+    # outside of it, so the window is grown and searched again until none do
+    while True:
+        fine = img.roi(window)
+        if fine is None:
+            return []
+
+        raw = Contours.from_img(fine).raw
+        if not any(_clipped_by_window(contour, fine, img) for contour in raw):
+            return raw
+
+        window = window.expand(margin)
+        margin *= 2
+
+
+class ContourBatch:
+    """
+    Every contour of a frame as flat arrays, so that geometry can be computed
+    for all of them at once instead of one Contour at a time.
+    points[offsets[i]:offsets[i + 1]] are the (x, y) points of contour i
+    """
+
+    def __init__(self, points: ndarray, offsets: ndarray, res: Point):
+        self.points = points  # (M, 2) int32
+        self.offsets = offsets  # (N + 1,) int
+        self.res = res
+
+    @classmethod
+    def from_raw(cls, raw: List[ndarray], res: Point) -> "ContourBatch":
+        offsets = np.zeros(len(raw) + 1, dtype=np.intp)
+        np.cumsum([len(contour) for contour in raw], out=offsets[1:])
+
+        if len(raw) == 0:
+            points = np.empty((0, 2), dtype=np.int32)
+        else:
+            points = np.concatenate(raw).reshape(-1, 2)
+
+        return cls(points, offsets, res)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def take(self, selector: ndarray) -> "ContourBatch":
+        """
+        selector: Indices or boolean mask of the contours to keep, in order
+
+        Properties that were already computed are carried over for the kept contours
+        """
+
+        selector = np.asarray(selector)
+        if selector.dtype == np.bool_:
+            selector = np.flatnonzero(selector)
+
+        lengths = np.diff(self.offsets)[selector]
+        offsets = np.zeros(len(selector) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # for every kept point, its index in self.points
+        point_index = np.repeat(self.offsets[selector] - offsets[:-1], lengths)
+        point_index += np.arange(offsets[-1])
+
+        inst = ContourBatch(self.points[point_index], offsets, self.res)
+
+        for name in _BATCH_PROPERTIES:
+            value = self.__dict__.get(name)
+            if isinstance(value, tuple):
+                inst.__dict__[name] = tuple(array[selector] for array in value)
+            elif value is not None:
+                inst.__dict__[name] = value[selector]
+
+        return inst
+
+    def raw(self, i: int) -> ndarray:  # (n, 1, 2) view, as returned by findContours
+        return self.points[self.offsets[i] : self.offsets[i + 1]].reshape(-1, 1, 2)
+
+    @cached_property
+    def _starts(self):
+        return self.offsets[:-1]
+
+    @cached_property
+    def moments(self) -> Tuple[ndarray, ndarray, ndarray]:
+        # m00, m10, m01 of every contour, using Green's theorem like cv2.moments
+        if len(self) == 0:
+            return (np.empty(0),) * 3
+
+        x = self.points[:, 0].astype(np.float64)
+        y = self.points[:, 1].astype(np.float64)
+
+        # index of the next point, wrapping around at the end of each contour
+        following = np.arange(1, len(x) + 1)
+        following[self.offsets[1:] - 1] = self._starts
+        x_next, y_next = x[following], y[following]
+
+        cross = x * y_next - x_next * y
+        m00 = np.add.reduceat(cross, self._starts) / 2
+        m10 = np.add.reduceat((x + x_next) * cross, self._starts) / 6
+        m01 = np.add.reduceat((y + y_next) * cross, self._starts) / 6
+
+        # cv2.moments does not depend on the direction of the contour
+        sign = np.where(m00 < 0, -1, 1)
+
+        return m00 * sign, m10 * sign, m01 * sign
+
+    @cached_property
+    def areas(self) -> ndarray:  # 0 - 1, percent of full area
+        if len(self) == 0:  # res may be unknown
+            return np.empty(0)
+
+        return self.moments[0] / self.res.area
+
+    @cached_property
+    def pixel_centroids(self) -> ndarray:  # (N, 2) of (x, y), unscaled
+        m00, m10, m01 = self.moments
+        area = m00 + 1e-5
+
+        return np.stack((m10 / area, m01 / area), axis=-1)
+
+    @cached_property
+    def centroids(self) -> ndarray:  # (N, 2) of (x, y), -1 to 1, (0, 0) is center
+        if len(self) == 0:  # res may be unknown
+            return np.empty((0, 2))
+
+        return (self.pixel_centroids * 2) / self.res - 1
+
+    @cached_property
+    def bounding_rects(self) -> ndarray:  # (N, 4) of (x, y, width, height)
+        if len(self) == 0:
+            return np.empty((0, 4), dtype=np.int32)
+
+        tl = np.minimum.reduceat(self.points, self._starts)
+        br = np.maximum.reduceat(self.points, self._starts)
+
+        return np.concatenate((tl, br - tl + 1), axis=-1)
+
+    @cached_property
+    def min_area_rects(self) -> Tuple[ndarray, ndarray, ndarray]:
+        # centers (N, 2), dimensions (N, 2) and angles (N,) of cv2.minAreaRect
+        rects = [cv2.minAreaRect(self.raw(i)) for i in range(len(self))]
+
+        centers = np.array([rect[0] for rect in rects], dtype=np.float64)
+        dims = np.array([rect[1] for rect in rects], dtype=np.float64)
+        angles = np.array([rect[2] for rect in rects], dtype=np.float64)
+
+        return centers.reshape(-1, 2), dims.reshape(-1, 2), angles
+
+    @cached_property
+    def vertical_angles(self) -> ndarray:  # See RotatedRect.vertical_angle
+        _, dims, angles = self.min_area_rects
+        return np.where(dims[:, 0] > dims[:, 1], angles + 90, angles)
+
+    @cached_property
+    def corners(self) -> Tuple[ndarray, ndarray]:
+        # found (N,) and corners (N, 4, 2), see Contour.corners
+        groups = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        found, corners = _find_corners(self.points, self.pixel_centroids, groups)
+
+        found &= np.diff(self.offsets) >= 4
+        return found, corners
+
+
+# Per-contour cached properties of ContourBatch, kept by ContourBatch.take
+_BATCH_PROPERTIES = (
+    "moments",
+    "areas",
+    "pixel_centroids",
+    "centroids",
+    "bounding_rects",
+    "min_area_rects",
+    "vertical_angles",
+    "corners",
+)
 
 
 FIND_CONTOURS_CONSTS = {"mode": cv2.RETR_EXTERNAL, "method": cv2.CHAIN_APPROX_SIMPLE}
 
 
 class Contours:
-    def nt_serialize(self):
-        centroids_x = [cnt.centroid.x for cnt in self.l]
-        centroids_y = [cnt.centroid.y for cnt in self.l]
-        areas = [cnt.area for cnt in self.l]
+    def nt_serialize(self, limit: int = None):  # limit: max contours to publish
+        batch = self.batch
+        centroids = nt_columns(batch.centroids, ("x", "y"), limit)
+
         return {
-            "x": centroids_x,
-            "y": centroids_y,
-            "area": areas,
-            "num_contours": len(self.l),
+            **centroids,
+            "area": batch.areas[:limit].tolist(),
+            "num_contours": len(centroids["x"]),
         }
 
     raw: List[ndarray]
@@ -177,16 +365,44 @@ class Contours:
         raise TypeError("Contours class must be made using Contours.from_* classmethod")
 
     @classmethod
-    def from_img(cls, img: MatBW):
-        vals = cv2.findContours(img.matBW.img, **FIND_CONTOURS_CONSTS)
+    def from_img(cls, img: MatBW, levels: int = 0):
+        """
+        levels: If above 0, contours are found on an image downsampled this many
+            times with pyrDown, then found again at full resolution around each
+        """
+
+        img = img.matBW
+
+        if levels > 0:
+            return cls._from_img_pyramid(img, levels)
+
+        # offset translates contours of a region of interest back to the full frame
+        vals = cv2.findContours(img.img, offset=img.offset, **FIND_CONTOURS_CONSTS)
 
         #  raw = vals[1]  # OPENCV3: image, contours, hierarchy
         raw = vals[0]  # OPENCV4: contours, hierarchy
 
-        inst = cls.from_raw(raw, img.res)
+        inst = cls.from_raw(raw, img.full_res)
 
         return inst
 
+    @classmethod
+    def _from_img_pyramid(cls, img: MatBW, levels: int):
+        coarse = cls.from_img(img.pyr_down(levels))
+        rects = [Rect.from_contour(raw) for raw in coarse.raw]
+
+        windows = pyramid_windows(img, rects, levels)
+        if windows is None:
+            return cls.from_img(img)
+
+        # Grown windows can overlap, finding the same contour more than once
+        raw = {}
+        for window in windows:
+            for contour in _find_in_window(img, window, pyramid_margin(levels)):
+                raw.setdefault((cv2.boundingRect(contour), len(contour)), contour)
+
+        return cls.from_raw(list(raw.values()), img.full_res)
+
     @classmethod
     def from_raw(cls, raw: List[ndarray], res):
         inst = cls.__new__(cls)
@@ -196,17 +412,28 @@ class Contours:
 
         return inst
 
+    @classmethod
+    def from_batch(cls, batch: ContourBatch):
+        inst = cls.__new__(cls)
+
+        inst.batch = batch
+        inst.res = batch.res
+
+        return inst
+
     @classmethod
     def from_contours(cls, contours: List[Contour], res=None):
         inst = cls.__new__(cls)
 
         inst.l = contours
-        inst.res = res
+        inst.res = res if (res is not None or not contours) else contours[0].res
 
         return inst
 
     @cached_property
-    def raw(self):  # used when contours is supplied but not raw
+    def raw(self):  # used when contours or batch is supplied but not raw
+        if "batch" in self.__dict__:
+            return [self.batch.raw(i) for i in range(len(self.batch))]
         return [contour.raw for contour in self.l]
 
     @cached_property
@@ -232,13 +459,20 @@ class Contours:
 
         return inst
 
+    @cached_property
+    def batch(self) -> ContourBatch:
+        return ContourBatch.from_raw(self.raw, self.res)
+
     @cached_property
     def centroids(self):
-        return [contour.pixel_centroid for contour in self.l]
+        return [Point(*centroid) for centroid in self.batch.pixel_centroids.tolist()]
 
     @cached_property
-    def centroid_of_all(self):
-        cx = sum(centroid[0] for centroid in self.centroids) / len(self.centroids)
-        cy = sum(centroid[1] for centroid in self.centroids) / len(self.centroids)
+    def bounding_rect(self) -> Union[Rect, None]:  # of every contour, or None if empty
+        if len(self.raw) == 0:
+            return None
+        return Rect.from_contour(np.concatenate(self.raw))
 
-        return Point(cx, cy)
+    @cached_property
+    def centroid_of_all(self):
+        return Point(*self.batch.pixel_centroids.mean(axis=0).tolist())
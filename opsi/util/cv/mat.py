@@ -1,5 +1,6 @@
 import math
-from typing import NamedTuple
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Sequence, Tuple
 
 import cv2
 import imutils
@@ -8,7 +9,7 @@ from numpy import ndarray
 
 from opsi.util.cache import cached_property
 
-from .shape import Circles, Point, Segments
+from .shape import Circles, Point, Rect, Segments
 
 _ERODE_DILATE_CONSTS = {
     "kernel": None,
@@ -17,15 +18,161 @@ _ERODE_DILATE_CONSTS = {
     "borderValue": -1,
 }
 
+_HUE_RANGE = 180  # OpenCV stores 8-bit hue as 0 - 179
+
+
+@lru_cache(maxsize=2 ** 4)
+def _hue_rotation_lut(offset: int) -> ndarray:
+    # Per-channel lookup table that shifts hue down by offset (mod 180),
+    # leaving saturation and value untouched
+    identity = np.arange(256, dtype=np.uint8)
+    hue = identity.copy()
+    hue[:_HUE_RANGE] = (np.arange(_HUE_RANGE) - offset) % _HUE_RANGE
+
+    return np.dstack((hue, identity, identity))
+
+
+_MAX_MULTI_RANGES = 8  # one bit of a uint8 per range
+
+# _BIT_LUTS[i] maps a byte to 255 if bit i is set, otherwise 0
+_BIT_LUTS = tuple(
+    np.where(np.arange(256) & (1 << i), 255, 0).astype(np.uint8)
+    for i in range(_MAX_MULTI_RANGES)
+)
+
+
+@lru_cache(maxsize=2 ** 4)
+def _multi_threshold_lut(ranges: Tuple[Tuple["Range", "Range", "Range"], ...]):
+    # One lookup table per channel, where bit i of lut[channel][x] is set
+    # if x is inside that channel's bounds for range i
+    values = np.arange(256)
+    lut = np.zeros((3, 256), dtype=np.uint8)
+
+    for i, (hue, sat, lum) in enumerate(ranges):
+        # same channel order as Mat.hsv_threshold
+        lower, upper = zip(hue, lum, sat)
+
+        for channel in range(3):
+            low, high = round(lower[channel]), round(upper[channel])
+            if channel == 0 and low > high:  # wrapping hue
+                member = (values >= low) | (values <= high)
+            else:
+                member = (values >= low) & (values <= high)
+            lut[channel] |= member.astype(np.uint8) << i
+
+    return lut
+
+
+_NO_OFFSET = Point(0, 0)
+
+_REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+_REDUCED_GREYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def _roi_view(image, rect: Rect):
+    # Returns (view, offset) of rect, given in full frame coordinates,
+    # clipped to image. Returns (None, None) if the clipped region is empty
+    x0 = max(int(rect.tl.x) - image.offset.x, 0)
+    y0 = max(int(rect.tl.y) - image.offset.y, 0)
+    x1 = min(int(math.ceil(rect.br.x)) - image.offset.x, image.res.x)
+    y1 = min(int(math.ceil(rect.br.y)) - image.offset.y, image.res.y)
+
+    if x0 >= x1 or y0 >= y1:
+        return None, None
+
+    offset = Point(image.offset.x + x0, image.offset.y + y0)
+    return image.img[y0:y1, x0:x1], offset
+
+
+# Above this many candidates, searching windows around each of them costs more
+# than searching the full image once
+MAX_PYRAMID_WINDOWS = 32
+
+
+def pyramid_margin(levels: int) -> int:
+    # Covers the detail lost while downsampling
+    return 2 * 2 ** levels
+
+
+def pyramid_windows(
+    image, coarse_rects: List[Rect], levels: int
+) -> Optional[List[Rect]]:
+    """
+    Scales rects found on image.pyr_down(levels) back up to full frame coordinates,
+    padded to cover the detail lost while downsampling and merged where they overlap.
+    Returns None if there are more than MAX_PYRAMID_WINDOWS, to search in full
+    """
+
+    if len(coarse_rects) > MAX_PYRAMID_WINDOWS:
+        return None
+
+    scale = 2 ** levels
+    margin = pyramid_margin(levels)
+
+    windows = [
+        Rect.from_params(
+            rect.tl.x * scale + image.offset.x,
+            rect.tl.y * scale + image.offset.y,
+            rect.dim.x * scale,
+            rect.dim.y * scale,
+        ).expand(margin)
+        for rect in coarse_rects
+    ]
+
+    return Rect.merge_overlapping(windows)
+
 
 class Mat:
-    def __init__(self, img: ndarray):
+    # The jpg this was decoded from, if it was, see from_jpg
+    jpg: Optional[bytes] = None
+
+    def __init__(self, img: ndarray, offset: Point = None, full_res: Point = None):
         self.img = img
         self.res = Point._make_rev(img.shape)
 
+        # If img is a region of interest of a larger frame, offset is the position
+        # of its top left corner in that frame, and full_res is the frame's size
+        self.offset = offset or _NO_OFFSET
+        self.full_res = full_res or self.res
+
+    @classmethod
+    def from_jpg(cls, jpg: ndarray, reduce: int = 1, grey: bool = False) -> "Mat":
+        """
+        reduce: 1, 2, 4 or 8. Decodes at that fraction of the resolution, which is
+            faster than decoding all of it and then resizing
+        grey: Decode only the luma, skipping colour conversion entirely
+
+        At full resolution, the jpg is kept, so it can be sent on without
+        encoding it again. Functions return new Mats rather than drawing on
+        their inputs, so it stays current.
+        """
+
+        flags = (_REDUCED_GREYSCALE if grey else _REDUCED_COLOR)[reduce]
+        img = cv2.imdecode(jpg, flags)
+        if img is None:
+            raise ValueError("Unable to decode jpg")
+
+        mat = cls(img)
+        if reduce == 1 and not grey:
+            mat.jpg = jpg.tobytes()
+        return mat
+
     @classmethod
     def from_matbw(cls, matbw: "MatBW") -> "Mat":
-        return cls(cv2.cvtColor(matbw.img, cv2.COLOR_GRAY2BGR))
+        return cls(
+            cv2.cvtColor(matbw.img, cv2.COLOR_GRAY2BGR), matbw.offset, matbw.full_res
+        )
 
     @property
     def mat(self):
@@ -35,6 +182,28 @@ class Mat:
     def matBW(self):
         raise TypeError
 
+    # Region of interest
+
+    @property
+    def is_roi(self) -> bool:
+        return self.res != self.full_res
+
+    def _same_roi(self, img: ndarray) -> "Mat":
+        return Mat(img, self.offset, self.full_res)
+
+    def roi(self, rect: Rect) -> Optional["Mat"]:
+        """
+        rect: Region in full frame coordinates, clipped to this image
+
+        Returns a view of the region without copying, or None if it is empty
+        """
+
+        img, offset = _roi_view(self, rect)
+        if img is None:
+            return None
+
+        return Mat(img, offset, self.full_res)
+
     # Operations
 
     def blur(self, radius: int) -> "Mat":
@@ -52,19 +221,54 @@ class Mat:
         # Bilateral Filter
         # img = cv2.bilateralFilter(self.img, -1, radius, radius)
 
-        return Mat(img)
+        return self._same_roi(img)
 
     def hsv_threshold(self, hue: "Range", sat: "Range", lum: "Range") -> "MatBW":
         """
-        hue: Hue range (min, max) (0 - 179)
+        hue: Hue range (min, max) (0 - 179), wraps around 0 if min > max
         sat: Saturation range (min, max) (0 - 255)
         lum: Value range (min, max) (0 - 255)
         """
 
+        hsv = cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV)
+
+        if hue[0] > hue[1]:
+            # Rotate hue in place so the wrapping range becomes contiguous,
+            # instead of thresholding twice and joining the masks.
+            # Bounds are rounded the same way inRange rounds them for 8-bit images
+            offset = min(round(hue[0]), _HUE_RANGE)
+            cv2.LUT(hsv, _hue_rotation_lut(offset), dst=hsv)
+            hue = (0, round(hue[1]) + _HUE_RANGE - offset)
+
         ranges = tuple(zip(hue, lum, sat))
-        img = cv2.inRange(cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV), *ranges)
+        img = cv2.inRange(hsv, *ranges)
+
+        return MatBW(img, self.offset, self.full_res)
+
+    def hsv_threshold_multi(
+        self, ranges: Sequence[Tuple["Range", "Range", "Range"]]
+    ) -> List["MatBW"]:
+        """
+        ranges: (hue, sat, lum) for each mask, with the same bounds as hsv_threshold
+
+        The HSV image is walked once, marking one bit per range in every pixel,
+        and each mask is then unpacked from the resulting single channel image
+        """
+
+        if len(ranges) > _MAX_MULTI_RANGES:
+            raise ValueError(f"Cannot threshold more than {_MAX_MULTI_RANGES} ranges")
+
+        lut = _multi_threshold_lut(tuple(tuple(r) for r in ranges))
+        hsv = self.hsv.img
+
+        combined = cv2.LUT(hsv[..., 0], lut[0])
+        cv2.bitwise_and(combined, cv2.LUT(hsv[..., 1], lut[1]), dst=combined)
+        cv2.bitwise_and(combined, cv2.LUT(hsv[..., 2], lut[2]), dst=combined)
 
-        return MatBW(img)
+        return [
+            MatBW(cv2.LUT(combined, _BIT_LUTS[i]), self.offset, self.full_res)
+            for i in range(len(ranges))
+        ]
 
     def encode_jpg(self, quality=None) -> bytes:
         params = ()
@@ -76,26 +280,47 @@ class Mat:
 
     @cached_property
     def greyscale(self) -> "Mat":
+        if self.img.ndim == 2:  # Already, see Function.input_formats
+            return self
         a = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
-        return Mat(a)
+        return self._same_roi(a)
+
+    @cached_property
+    def bgr(self) -> "Mat":
+        if self.img.ndim == 3:
+            return self
+        a = cv2.cvtColor(self.img, cv2.COLOR_GRAY2BGR)
+        return self._same_roi(a)
 
     @cached_property
     def hsv(self) -> "Mat":
         a = cv2.cvtColor(self.img, cv2.COLOR_BGR2HSV)
-        return Mat(a)
+        return self._same_roi(a)
 
     def resize(self, res: Point) -> "Mat":
         return Mat(cv2.resize(self.img, res))
 
+    def pyr_down(self, levels: int = 1) -> "Mat":
+        # The result is not a region of interest, its coordinates are relative to self
+        img = self.img
+        for _ in range(levels):
+            img = cv2.pyrDown(img)
+
+        return Mat(img)
+
     def color_balance(self, red_balance: float, blue_balance: float):
         a = np.multiply(self.img, np.array([blue_balance, 1.0, red_balance,])).astype(
             np.uint8
         )
 
-        return Mat(a)
+        return self._same_roi(a)
 
     def canny(self, threshold_lower, threshold_upper) -> "MatBW":
-        return MatBW(cv2.Canny(self.img, threshold_lower, threshold_upper))
+        return MatBW(
+            cv2.Canny(self.img, threshold_lower, threshold_upper),
+            self.offset,
+            self.full_res,
+        )
 
     def hough_circles(
         self,
@@ -105,7 +330,18 @@ class Mat:
         param2: int,
         min_radius: int,
         max_radius: int,
+        levels: int = 0,
     ) -> "Circles":
+        """
+        levels: If above 0, circles are detected on an image downsampled this many
+            times with pyrDown, then each is refined at full resolution
+        """
+
+        if levels > 0:
+            return self._hough_circles_pyramid(
+                dp, min_dist, param1, param2, min_radius, max_radius, levels
+            )
+
         circles = cv2.HoughCircles(
             self.img,
             method=cv2.HOUGH_GRADIENT,
@@ -118,11 +354,63 @@ class Mat:
         )
         if circles is None:
             return None
-        else:
-            return circles.view(Circles)
+
+        if self.offset != _NO_OFFSET:  # translate back to full frame
+            circles[..., :2] += self.offset
+
+        return circles.view(Circles)
+
+    def _hough_circles_pyramid(
+        self, dp, min_dist, param1, param2, min_radius, max_radius, levels
+    ):
+        scale = 2 ** levels
+        margin = pyramid_margin(levels)
+
+        # Votes are proportional to circumference, so scale param2 along with radii
+        coarse = self.pyr_down(levels).hough_circles(
+            dp,
+            max(min_dist / scale, 1),
+            param1,
+            max(param2 / scale, 1),
+            min_radius // scale,
+            -(-max_radius // scale) if max_radius > 0 else max_radius,
+        )
+        if coarse is None:
+            return None
+
+        refined = []
+        for x, y, radius in coarse[0]:
+            x = x * scale + self.offset.x
+            y = y * scale + self.offset.y
+            radius = radius * scale
+
+            window = Rect.from_params(x, y, 0, 0).expand(radius + margin)
+            low = max(min_radius, int(radius - margin))
+            high = int(radius + margin)
+            if max_radius > 0:
+                high = min(high, max_radius)
+
+            roi = self.roi(window)
+            if roi is None:
+                continue
+            circles = roi.hough_circles(dp, min_dist, param1, param2, low, high)
+            if circles is None:
+                continue
+
+            circle = circles[0, 0]  # strongest circle in the window
+            if all(
+                math.hypot(circle[0] - other[0], circle[1] - other[1]) >= min_dist
+                for other in refined
+            ):
+                refined.append(circle)
+
+        if not refined:
+            return None
+
+        return np.array([refined], dtype=np.float32).view(Circles)
 
     def abs_diff(self, scalar: ndarray) -> "Mat":
-        return Mat(cv2.absdiff(self.img, scalar))
+        return self._same_roi(cv2.absdiff(self.img, scalar))
 
     def flip_horizontally(self):
         return Mat(cv2.flip(self.img, 1))
@@ -138,11 +426,15 @@ class Mat:
 
 
 class MatBW:
-    def __init__(self, img: ndarray):
+    def __init__(self, img: ndarray, offset: Point = None, full_res: Point = None):
         self.img = img
         self._mat = None
         self.res = Point._make_rev(img.shape)
 
+        # See Mat.__init__
+        self.offset = offset or _NO_OFFSET
+        self.full_res = full_res or self.res
+
     @property
     def mat(self):
         if self._mat is None:  # TODO: should this be cached? draw on mat in place?
@@ -153,25 +445,51 @@ class MatBW:
     def matBW(self):
         return self
 
+    # Region of interest
+
+    @property
+    def is_roi(self) -> bool:
+        return self.res != self.full_res
+
+    def _same_roi(self, img: ndarray) -> "MatBW":
+        return MatBW(img, self.offset, self.full_res)
+
+    def roi(self, rect: Rect) -> Optional["MatBW"]:
+        # See Mat.roi
+        img, offset = _roi_view(self, rect)
+        if img is None:
+            return None
+
+        return MatBW(img, offset, self.full_res)
+
     # Operations
 
     def erode(self, size: int) -> "MatBW":
-        return MatBW(
+        return self._same_roi(
             cv2.erode(self.img, iterations=round(size), **_ERODE_DILATE_CONSTS)
         )
 
     def dilate(self, size: int) -> "MatBW":
-        return MatBW(
+        return self._same_roi(
             cv2.dilate(self.img, iterations=round(size), **_ERODE_DILATE_CONSTS)
         )
 
     @cached_property
     def invert(self) -> "MatBW":
-        return MatBW(cv2.bitwise_not(self.img))
+        return self._same_roi(cv2.bitwise_not(self.img))
 
     @classmethod
     def join(cls, img1: "MatBW", img2: "MatBW") -> "MatBW":
-        return MatBW(cv2.bitwise_or(img1.img, img2.img))
+        return img1._same_roi(cv2.bitwise_or(img1.img, img2.img))
+
+    def pyr_down(self, levels: int = 1) -> "MatBW":
+        # Any pixel touching the mask stays set, so small targets are not lost
+        # The result is not a region of interest, its coordinates are relative to self
+        img = self.img
+        for _ in range(levels):
+            img = cv2.pyrDown(img)
+
+        return MatBW(cv2.threshold(img, 0, 255, cv2.THRESH_BINARY)[1])
 
     def hough_lines(
         self,
@@ -180,7 +498,18 @@ class MatBW:
         min_length: int,
         max_gap: int,
         theta: float = math.pi / 180.0,
+        levels: int = 0,
     ) -> "Segments":
+        """
+        levels: If above 0, segments are detected on an image downsampled this many
+            times with pyrDown, then redetected at full resolution around each
+        """
+
+        if levels > 0:
+            return self._hough_lines_pyramid(
+                rho, threshold, min_length, max_gap, theta, levels
+            )
+
         segments = cv2.HoughLinesP(
             self.img,
             rho=rho,
@@ -191,8 +520,45 @@ class MatBW:
         )
         if segments is None:
             return None
-        else:
-            return segments.view(Segments)
+
+        if self.offset != _NO_OFFSET:  # translate back to full frame
+            segments[..., :2] += self.offset
+            segments[..., 2:] += self.offset
+
+        return segments.view(Segments)
+
+    def _hough_lines_pyramid(self, rho, threshold, min_length, max_gap, theta, levels):
+        scale = 2 ** levels
+
+        # Votes are proportional to length, so scale threshold along with lengths
+        coarse = self.pyr_down(levels).hough_lines(
+            rho, max(threshold // scale, 1), min_length / scale, max_gap / scale, theta
+        )
+        if coarse is None:
+            return None
+
+        rects = [
+            Rect.from_params(min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1))
+            for x1, y1, x2, y2 in coarse.reshape(-1, 4)
+        ]
+
+        windows = pyramid_windows(self, rects, levels)
+        if windows is None:
+            return self.hough_lines(rho, threshold, min_length, max_gap, theta)
+
+        found = []
+        for window in windows:
+            roi = self.roi(window)
+            if roi is None:
+                continue
+            segments = roi.hough_lines(rho, threshold, min_length, max_gap, theta)
+            if segments is not None:
+                found.append(segments)
+
+        if not found:
+            return None
+
+        return np.concatenate(found).view(Segments)
 
 
 class Color(NamedTuple):
@@ -1,5 +1,5 @@
 from math import atan2, cos, sin, sqrt
-from typing import NamedTuple
+from typing import List, NamedTuple
 
 import cv2
 import numpy as np
@@ -8,6 +8,16 @@ from numpy import ndarray
 from opsi.util.cache import cached_property
 
 
+def nt_columns(array: ndarray, names, limit: int = None) -> dict:
+    """
+    Returns {name: list of floats} for each column of an (N, len(names)) array,
+    keeping only the first limit rows if given
+    """
+
+    rows = np.asarray(array).reshape(-1, len(names))[:limit]
+    return dict(zip(names, rows.T.astype(np.float64).tolist()))
+
+
 # Also represents dimensions
 class Point(NamedTuple):
     def nt_serialize(self):
@@ -78,6 +88,71 @@ class Rect(Shape):
     def from_contour(cls, contour_raw):
         return cls.from_params(*cv2.boundingRect(contour_raw))
 
+    # grow by margin on every side
+    def expand(self, margin_x, margin_y=None) -> "Rect":
+        if margin_y is None:
+            margin_y = margin_x
+
+        return Rect.from_params(
+            self.tl.x - margin_x,
+            self.tl.y - margin_y,
+            self.dim.x + 2 * margin_x,
+            self.dim.y + 2 * margin_y,
+        )
+
+    def intersects(self, other: "Rect") -> bool:
+        return (
+            self.tl.x < other.br.x
+            and other.tl.x < self.br.x
+            and self.tl.y < other.br.y
+            and other.tl.y < self.br.y
+        )
+
+    def union(self, other: "Rect") -> "Rect":
+        x = min(self.tl.x, other.tl.x)
+        y = min(self.tl.y, other.tl.y)
+
+        return Rect.from_params(
+            x, y, max(self.br.x, other.br.x) - x, max(self.br.y, other.br.y) - y
+        )
+
+    # combine every group of intersecting rects into their union
+    @classmethod
+    def merge_overlapping(cls, rects: List["Rect"]) -> List["Rect"]:
+        # Sweeps across x, so only rects overlapping along x are compared. A union
+        # may intersect rects its parts did not, so this repeats until none merge
+        while True:
+            merged = cls._merge_pass(rects)
+            if len(merged) == len(rects):
+                return merged
+            rects = merged
+
+    @classmethod
+    def _merge_pass(cls, rects: List["Rect"]) -> List["Rect"]:
+        groups = list(range(len(rects)))  # union-find, each rect's group
+
+        def find(i):
+            while groups[i] != i:
+                groups[i] = groups[groups[i]]
+                i = groups[i]
+            return i
+
+        active = []  # rects which may still overlap the next one along x
+        for i in sorted(range(len(rects)), key=lambda i: rects[i].tl.x):
+            rect = rects[i]
+            active = [j for j in active if rects[j].br.x > rect.tl.x]
+            for j in active:
+                if rect.intersects(rects[j]):
+                    groups[find(j)] = find(i)
+            active.append(i)
+
+        unions = {}
+        for i, rect in enumerate(rects):
+            group = find(i)
+            unions[group] = unions[group].union(rect) if group in unions else rect
+
+        return list(unions.values())
+
     @cached_property
     def tr(self):
         return Point(self.tl.x + self.dim.x, self.tl.y)
@@ -168,6 +243,10 @@ class Corners(NamedTuple):
     bl: Point
     br: Point
 
+    @classmethod
+    def from_array(cls, array: ndarray) -> "Corners":  # (4, 2) of tl, tr, bl, br
+        return cls(*(Point(*point) for point in array.tolist()))
+
     def to_matrix(self):
         return np.array([self.tl, self.tr, self.bl, self.br], dtype=np.float)
 
@@ -230,19 +309,10 @@ class Pose3D(NamedTuple):
 
 
 class Circles(ndarray):
-    def nt_serialize(self):
-        return {
-            "x": [float(circle[0]) for circle in self[0]],
-            "y": [float(circle[1]) for circle in self[0]],
-            "radius": [float(circle[2]) for circle in self[0]],
-        }
+    def nt_serialize(self, limit: int = None):
+        return nt_columns(self, ("x", "y", "radius"), limit)
 
 
 class Segments(ndarray):
-    def nt_serialize(self):
-        return {
-            "x1": [float(seg[0][0]) for seg in self],
-            "y1": [float(seg[0][1]) for seg in self],
-            "x2": [float(seg[0][2]) for seg in self],
-            "y2": [float(seg[0][3]) for seg in self],
-        }
+    def nt_serialize(self, limit: int = None):
+        return nt_columns(self, ("x1", "y1", "x2", "y2"), limit)
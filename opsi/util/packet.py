@@ -0,0 +1,110 @@
+import struct
+from numbers import Real
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+# Binary format of a single result, shared by the UDP and shared memory outputs.
+# Only needs numpy, so consumers can use it without the rest of OpenSight.
+#
+# A fixed 24 byte little endian header, then a fixed number of float64 values
+# depending on its kind:
+#
+#   offset  type     field
+#   0       char[4]  magic, b"OPSI"
+#   4       uint8    format version
+#   5       uint8    kind, see KIND_SIZES
+#   6       uint16   channel, set by the sender to tell its values apart
+#   8       uint32   sequence number, wrapping around
+#   12      (4 bytes padding)
+#   16      float64  timestamp, seconds since the epoch when it was sent
+#   24      float64  values...
+
+HEADER = struct.Struct("<4sBBHI4xd")
+MAGIC = b"OPSI"
+VERSION = 1
+
+# Number of values sent for each kind
+KIND_NONE = 0  # No value, such as when there is no target
+KIND_NUMBER = 1  # value
+KIND_POINT = 2  # x, y
+KIND_POSE = 3  # rvec x, y, z, tvec x, y, z
+KIND_CORNERS = 4  # tl x, y, tr x, y, bl x, y, br x, y
+KIND_SIZES = {
+    KIND_NONE: 0,
+    KIND_NUMBER: 1,
+    KIND_POINT: 2,
+    KIND_POSE: 6,
+    KIND_CORNERS: 8,
+}
+
+MAX_SIZE = HEADER.size + 8 * max(KIND_SIZES.values())
+
+
+def packet_size(kind: int) -> int:
+    return HEADER.size + 8 * KIND_SIZES[kind]
+
+
+def write_value(values: np.ndarray, value) -> int:
+    """
+    Writes the values of a number, Point, Pose3D or Corners into a float64 array
+    of at least 8, and returns its kind. Checked by shape rather than type, so
+    this does not need opsi.util.cv
+    """
+
+    if value is None:
+        return KIND_NONE
+
+    if hasattr(value, "rvec") and hasattr(value, "tvec"):  # Pose3D
+        values[0:3] = value.rvec.ravel()
+        values[3:6] = value.tvec.ravel()
+        return KIND_POSE
+
+    if isinstance(value, tuple) and len(value) == 4:  # Corners
+        for i, (x, y) in enumerate(value):
+            values[2 * i] = x
+            values[2 * i + 1] = y
+        return KIND_CORNERS
+
+    if isinstance(value, tuple) and len(value) == 2:  # Point
+        values[0] = value[0]
+        values[1] = value[1]
+        return KIND_POINT
+
+    if isinstance(value, (Real, np.number, np.bool_)):  # Also bool
+        values[0] = value
+        return KIND_NUMBER
+
+    raise TypeError(f"Type {value.__class__.__name__} cannot be written as a packet")
+
+
+class Packet(NamedTuple):
+    kind: int
+    channel: int
+    sequence: int
+    timestamp: float  # When it was sent
+    received: float  # When it was received
+    values: Tuple[float, ...]
+
+    @property
+    def latency(self) -> float:  # Only meaningful if both ends share a clock
+        return self.received - self.timestamp
+
+
+def read_packet(buffer, size: int, received: float) -> Packet:
+    # Raises ValueError if buffer[:size] is not a packet in the format above
+
+    if size < HEADER.size:
+        raise ValueError(f"Packet of {size} bytes is too short")
+
+    magic, version, kind, channel, sequence, timestamp = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Packet is not in a known format")
+
+    count = KIND_SIZES.get(kind)
+    if count is None or size != HEADER.size + 8 * count:
+        raise ValueError(f"Packet of {size} bytes does not match kind {kind}")
+
+    values = struct.unpack_from(f"<{count}d", buffer, HEADER.size)
+
+    return Packet(kind, channel, sequence, timestamp, received, values)
@@ -0,0 +1,171 @@
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from .packet import (
+    HEADER,
+    KIND_SIZES,
+    MAGIC,
+    MAX_SIZE,
+    VERSION,
+    Packet,
+    packet_size,
+    read_packet,
+    write_value,
+)
+
+# A shared memory segment holds the latest packet (see opsi.util.packet) written
+# to it, behind a seqlock: a uint64 which is odd while the packet is being
+# written. Readers copy the segment, and retry if the lock was odd or the
+# checksum does not match the copy. Neither side makes a syscall or waits for
+# the other.
+#
+# Stores to the mapping can become visible to another core in any order (on ARM
+# they do), so a reader can see the new lock before the packet it guards. The
+# checksum is checked on the reader's own copy, so a packet torn by a write is
+# rejected however the stores were ordered.
+#
+#   offset  type     field
+#   0       uint64   lock, 0 until the first packet is written
+#   8       uint32   CRC-32 of the lock's 8 bytes, then the packet's
+#   12      4 bytes  padding
+#   16      packet
+
+SEQLOCK = struct.Struct("<Q")
+SEGMENT_HEADER = struct.Struct("<QI4x")  # lock, checksum
+SEGMENT_SIZE = SEGMENT_HEADER.size + MAX_SIZE
+
+_CHECKSUM = struct.Struct("<I")
+_KIND_OFFSET = 5  # of the kind in the packet header
+
+
+def checksum(lock: int, packet) -> int:
+    return zlib.crc32(packet, zlib.crc32(SEQLOCK.pack(lock)))
+
+
+def segment_path(name: str) -> Path:
+    # POSIX shared memory is backed by /dev/shm on Linux
+    directory = Path("/dev/shm")
+    if not directory.is_dir():
+        directory = Path(tempfile.gettempdir())
+
+    return directory / f"opensight-{name}"
+
+
+class SharedMemoryWriter:
+    """
+    The segment is kept when the writer is closed, so readers keep working
+    across pipeline restarts
+    """
+
+    def __init__(self, name: str, channel: int = 0):
+        self.path = segment_path(name)
+        self.channel = channel
+        self.sequence = 0
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SEGMENT_SIZE)
+            self.map = mmap.mmap(fd, SEGMENT_SIZE)
+        finally:
+            os.close(fd)
+
+        # Continue from a previous writer, so the lock never goes backwards.
+        # If it is odd, that writer stopped partway through a packet
+        lock = SEQLOCK.unpack_from(self.map)[0]
+        self.lock = lock + (lock & 1)
+
+        # Packets are put together here, and copied into the segment in one go,
+        # so the lock is odd for as short a time as possible
+        self.buffer = bytearray(MAX_SIZE)
+        self.values = np.frombuffer(self.buffer, np.float64, offset=HEADER.size)
+        self.views = {
+            kind: memoryview(self.buffer)[: packet_size(kind)] for kind in KIND_SIZES
+        }
+
+    def write(self, value) -> None:
+        kind = write_value(self.values, value)
+
+        HEADER.pack_into(
+            self.buffer,
+            0,
+            MAGIC,
+            VERSION,
+            kind,
+            self.channel,
+            self.sequence,
+            time.time(),
+        )
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+
+        view = self.views[kind]
+        start = SEGMENT_HEADER.size
+
+        self.lock += 1
+        SEQLOCK.pack_into(self.map, 0, self.lock)
+        _CHECKSUM.pack_into(self.map, SEQLOCK.size, checksum(self.lock + 1, view))
+        self.map[start : start + len(view)] = view
+        self.lock += 1
+        SEQLOCK.pack_into(self.map, 0, self.lock)
+
+    def close(self):
+        self.map.close()
+
+
+class SharedMemoryReader:
+    """
+    Reads the latest packet from a segment of a SharedMemoryWriter on the same
+    machine. Raises FileNotFoundError if no writer has created the segment yet
+    """
+
+    def __init__(self, name: str):
+        self.path = segment_path(name)
+
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), SEGMENT_SIZE, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        self.buffer = bytearray(SEGMENT_SIZE)
+        self.packet = memoryview(self.buffer)[SEGMENT_HEADER.size :]
+
+    def read(self, retries: int = 1000) -> Optional[Packet]:
+        """
+        Returns None if nothing has been written yet, or if the writer was still
+        writing after this many attempts. Raises ValueError if the segment does
+        not hold a packet
+        """
+
+        for _ in range(retries):
+            self.buffer[:] = self.view
+            lock, expected = SEGMENT_HEADER.unpack_from(self.buffer)
+            if lock == 0:
+                return None
+            if lock & 1:
+                continue
+
+            kind = self.packet[_KIND_OFFSET]
+            size = packet_size(kind) if kind in KIND_SIZES else len(self.packet)
+            if checksum(lock, self.packet[:size]) == expected:
+                break
+        else:
+            return None
+
+        return read_packet(self.packet, size, time.time())
+
+    def close(self):
+        self.packet.release()
+        self.view.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,141 @@
+import logging
+import socket
+import threading
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .packet import (
+    HEADER,
+    KIND_SIZES,
+    MAGIC,
+    MAX_SIZE,
+    VERSION,
+    Packet,
+    packet_size,
+    read_packet,
+    write_value,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# Datagrams are packets, see opsi.util.packet for the format
+
+RESOLVE_INTERVAL = 1.0  # seconds between attempts to look up the host
+
+
+class UDPSender:
+    """
+    The host is looked up on a background thread, since that can block for
+    seconds, as with an mDNS name while the robot is unreachable. Datagrams are
+    dropped until it is found
+    """
+
+    def __init__(self, host: str, port: int, channel: int = 0):
+        self.host = host
+        self.port = port
+        self.channel = channel
+        self.sequence = 0
+
+        self.address: Optional[Tuple[str, int]] = None
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+        # Every datagram is written into this buffer, and sent through a view of it
+        self.buffer = bytearray(MAX_SIZE)
+        self.values = np.frombuffer(self.buffer, np.float64, offset=HEADER.size)
+        self.views = {
+            kind: memoryview(self.buffer)[: packet_size(kind)] for kind in KIND_SIZES
+        }
+
+        self._closed = threading.Event()
+        self._resolver = None
+        if not self._resolve(socket.AI_NUMERICHOST):  # An address needs no lookup
+            self._resolver = threading.Thread(
+                target=self._resolve_until_found, name="UDP resolver", daemon=True
+            )
+            self._resolver.start()
+
+    def _resolve(self, flags: int = 0) -> bool:
+        try:
+            info = socket.getaddrinfo(
+                self.host, self.port, socket.AF_INET, socket.SOCK_DGRAM, 0, flags
+            )
+        except OSError:
+            return False
+
+        self.address = info[0][4]
+        return True
+
+    def _resolve_until_found(self):
+        # Retried, since mDNS names are often not available until the robot is up
+        while not self._closed.is_set():
+            if self._resolve():
+                return
+            LOGGER.debug("Failed to resolve UDP host %s", self.host)
+            self._closed.wait(RESOLVE_INTERVAL)
+
+    def send(self, value) -> None:
+        address = self.address
+        if address is None:  # Not found yet, see _resolve_until_found
+            return
+
+        kind = write_value(self.values, value)
+
+        HEADER.pack_into(
+            self.buffer,
+            0,
+            MAGIC,
+            VERSION,
+            kind,
+            self.channel,
+            self.sequence,
+            time.time(),
+        )
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+
+        try:
+            self.socket.sendto(self.views[kind], address)
+        except OSError:  # Such as no route to the robot, or a full send buffer
+            LOGGER.debug("Failed to send UDP datagram", exc_info=True)
+
+    def close(self):
+        self._closed.set()
+        self.socket.close()
+
+
+class UDPReceiver:
+    """
+    Receives datagrams sent by UDPSender. Binds to an unused port on the
+    loopback interface by default, for tests and latency measurement
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.host, self.port = self.socket.getsockname()
+
+        self.buffer = bytearray(MAX_SIZE)
+
+    def receive(self, timeout: Optional[float] = 1.0) -> Packet:
+        """
+        Raises socket.timeout if nothing arrives in time, and ValueError if a
+        datagram is not a packet
+        """
+
+        self.socket.settimeout(timeout)
+        size = self.socket.recv_into(self.buffer)
+        received = time.time()
+
+        return read_packet(self.buffer, size, received)
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
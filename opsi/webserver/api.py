@@ -28,6 +28,7 @@ class Api:
         self.app.get("/funcs", response_model=SchemaF)(self.read_funcs)
         self.app.get("/nodes", response_model=NodeTreeN)(self.read_nodes)
         self.app.get("/config", response_model=FrontendSettings)(self.read_config)
+        self.app.get("/stats/nt")(self.read_nt_stats)
         self.app.post("/nodes")(self.save_nodes)
         self.app.post("/calibration")(self.save_calibration)
         self.app.post("/upgrade")(self.upgrade)
@@ -75,6 +76,16 @@ class Api:
             ),
         )
 
+    def read_nt_stats(self):
+        # Stream stats are served by the videoio hook, see CamHook.get_stats
+        try:
+            stats = self.program.pipeline.get_nt_publish_stats()
+        except ValueError as e:
+            json = {"error": "No NT stats", "message": e.args[0]}
+            return JSONResponse(status_code=404, content=json)
+
+        return {name: perf._asdict() for name, perf in stats.items()}
+
     def save_nodes(self, *, nodetree: NodeTreeN, force_save: bool = False):
         import_nodetree(self.program, nodetree, force_save)
         # only save if successful import
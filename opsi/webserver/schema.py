@@ -73,6 +73,8 @@ class Network(BaseModel):
     static_ext: str = 100
     nt_enabled: bool = True
     nt_client: bool = True
+    nt_max_rate: int = 100  # Max NT flushes per second, 0 for no limit
+    stream_max_mbps: float = 0  # Of all camera streams, 0 for no limit
 
     @validator("team", always=True)
     def team_formatter(cls, team):
@@ -99,6 +101,20 @@ class Network(BaseModel):
 
         return static_ext
 
+    @validator("nt_max_rate", always=True)
+    def nt_max_rate_validator(cls, nt_max_rate):
+        if nt_max_rate < 0:
+            raise ValueError("NT flush rate cannot be negative")
+
+        return nt_max_rate
+
+    @validator("stream_max_mbps", always=True)
+    def stream_max_mbps_validator(cls, stream_max_mbps):
+        if stream_max_mbps < 0:
+            raise ValueError("Stream bandwidth cannot be negative")
+
+        return stream_max_mbps
+
 
 class Preferences(BaseModel):
     profile: int = 0
@@ -258,9 +258,10 @@ def _process_node_settings(program, node: "NodeN"):
         raise NodeTreeImportError(program, node, "Invalid settings")
 
     if (
-        (real_node.func_type.require_restart)  # restart only on changed settings
-        and (real_node.settings is not None)
-        and (not real_node.settings == settings)
+        (real_node.settings is not None)  # restart only on changed settings
+        and _needs_restart(
+            real_node.func_type.require_restart, real_node.settings, settings
+        )
     ) or real_node.func_type.always_restart:  # or if force always
         real_node.dispose()
 
@@ -270,6 +271,13 @@ def _process_node_settings(program, node: "NodeN"):
     real_node.settings = settings
 
 
+def _needs_restart(require_restart, old, new) -> bool:
+    # require_restart is a bool, or the names of the settings that need one
+    if isinstance(require_restart, bool):
+        return require_restart and old != new
+    return any(getattr(old, name) != getattr(new, name) for name in require_restart)
+
+
 def _remove_unneeded_nodes(program, nodetree: "NodeTreeN") -> Tuple["NodeTreeN", bool]:
     visited = set()
     queue = deque()